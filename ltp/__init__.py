@@ -1,16 +1,25 @@
 import logging
+from django.conf import settings
+from django.db import transaction
+from squad.core.models import Test
 from squad.plugins import Plugin as BasePlugin
 
 
 logger = logging.getLogger()
 
+# Number of tests whose log is written per UPDATE, and read per query
+DEFAULT_BULK_UPDATE_BATCH_SIZE = 500
+FAILED_TESTS_CHUNK_SIZE = 2000
+
 
 class LtpLogs(BasePlugin):
     name = "LTP Logs"
 
     def postprocess_testrun(self, testrun):
         log_lines = testrun.log_file.split('\n')
-        for test in testrun.tests.filter(result=False):
+        failed = testrun.tests.filter(result=False).select_related('metadata').only('id', 'log', 'metadata__name')
+        updated_tests = []
+        for test in failed.iterator(chunk_size=FAILED_TESTS_CHUNK_SIZE):
             logger.debug("Assigning LTP logs to %s" % test.name)
             log = [line for line in log_lines if line.startswith(test.name)]
 
@@ -18,4 +27,11 @@ class LtpLogs(BasePlugin):
                 if test.log is not None:
                     log = [test.log] + log
                 test.log = '\n'.join(log)
-                test.save()
+                updated_tests.append(test)
+
+        if len(updated_tests) == 0:
+            return
+
+        batch_size = getattr(settings, "PLUGINS_BULK_UPDATE_BATCH_SIZE", DEFAULT_BULK_UPDATE_BATCH_SIZE)
+        with transaction.atomic():
+            Test.objects.bulk_update(updated_tests, ['log'], batch_size=batch_size)
@@ -1,5 +1,8 @@
 import logging
+import requests
+from squad.ci.exceptions import TemporaryFetchIssue
 from squad.plugins import Plugin as BasePlugin
+from squadplugins.http import get_session
 from urllib.parse import urlparse, urljoin
 
 
@@ -9,6 +12,21 @@ logger = logging.getLogger()
 class Mmtests(BasePlugin):
     name = "Mmtests"
 
+    def _tuxsuite_headers(self, tuxsuite, testjob):
+        """
+            Return the same authentication headers the Tuxsuite backend sends, so
+            that attachments of private groups can be fetched
+        """
+        token = tuxsuite.__resolve_settings__(testjob).get('TUXSUITE_TOKEN')
+        return {'Authorization': token} if token else {}
+
+    def _fetch_url(self, session, url, headers):
+        # Errors are reported like the backend's fetch_url does, so the fetch is retried
+        try:
+            return session.get(url, headers=headers)
+        except requests.exceptions.RequestException as e:
+            raise TemporaryFetchIssue(f"Can't retrieve from {url}: {e}")
+
     def postprocess_testjob(self, testjob):
         if testjob.backend.implementation_type != "tuxsuite":
             logger.debug("Mmtests runs only on Tuxsuite backends for now")
@@ -26,7 +44,12 @@ class Mmtests(BasePlugin):
         attachments_url = urljoin("https://storage.tuxsuite.com", job_url_path)
         attachments_url = urljoin(attachments_url, "attachments") + "/"
 
-        response = tuxsuite.fetch_url(attachments_url)
+        # Use the plugins' pooled session so connections to storage.tuxsuite.com
+        # are kept alive across the many small attachment downloads
+        session = get_session()
+        headers = self._tuxsuite_headers(tuxsuite, testjob)
+        response = self._fetch_url(session, attachments_url, headers)
+
         if response.status_code != 200:
             logger.debug(f"Failed to run Mmtests plugin: bad http response {response.status_code} when fetching {attachments_url}")
             return
@@ -38,7 +61,7 @@ class Mmtests(BasePlugin):
             return
 
         for url in file_urls:
-            response = tuxsuite.fetch_url(url)
+            response = self._fetch_url(session, url, headers)
             if response.status_code != 200:
                 logger.error(f"Failed to run Mmtests plugin: bad http response {response.status_code} when fetching file at {url}")
                 continue
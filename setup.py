@@ -6,7 +6,7 @@ setup(
     author='Charles Oliveira',
     author_email='charles.oliveira@linaro.org',
     url='https://github.com/linaro/squadplugins',
-    packages=['tradefed', 'ltp', 'mmtests'],
+    packages=['squadplugins', 'tradefed', 'ltp', 'mmtests'],
     entry_points={
         'squad_plugins': [
             'tradefed=tradefed:Tradefed',
@@ -0,0 +1,95 @@
+import os
+import requests
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter, Retry
+
+
+__session__ = None
+__session_pid__ = None
+
+# Connection pool size for hosts that don't have one in PLUGINS_HTTP_POOL_SIZES
+DEFAULT_POOL_MAXSIZE = 10
+
+# Connection pool size per host, extended/overridden by PLUGINS_HTTP_POOL_SIZES
+DEFAULT_POOL_SIZES = {
+    'tuxapi.tuxsuite.com': 10,
+    'storage.tuxsuite.com': 20,
+    'lkft-cache.lkftlab': 20,
+}
+
+
+def _build_session():
+    retry_strategy = Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504])
+
+    pool_maxsize = getattr(settings, "PLUGINS_HTTP_POOL_MAXSIZE", DEFAULT_POOL_MAXSIZE)
+    pool_sizes = dict(DEFAULT_POOL_SIZES)
+    pool_sizes.update(getattr(settings, "PLUGINS_HTTP_POOL_SIZES", {}))
+
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    # Hosts that see a lot of traffic get their own, larger, pool
+    for host, size in pool_sizes.items():
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=size)
+        session.mount(f'http://{host}/', adapter)
+        session.mount(f'https://{host}/', adapter)
+
+    return session
+
+
+def get_session():
+    """
+        Return the requests session shared by the plugins in this process.
+
+        Pooled sockets must not be shared between processes, so a session created
+        before a fork (e.g. by a Celery prefork parent) is discarded and rebuilt
+        the first time the child process asks for it.
+    """
+    global __session__, __session_pid__
+    if __session__ is None or __session_pid__ != os.getpid():
+        __session__ = _build_session()
+        __session_pid__ = os.getpid()
+    return __session__
+
+
+def reset_session():
+    global __session__, __session_pid__
+    __session__ = None
+    __session_pid__ = None
+
+
+def get_pool_stats():
+    """
+        Return connection pool counters per host for the current session: how many
+        requests were sent, how many of them reused a pooled connection (hits) and
+        how many required a new connection (misses).
+    """
+
+    stats = {}
+    if __session__ is None:
+        return stats
+
+    adapters = {id(adapter): adapter for adapter in __session__.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+
+            host_stats = stats.setdefault(pool.host, {'requests': 0, 'hits': 0, 'misses': 0})
+            host_stats['requests'] += pool.num_requests
+            host_stats['misses'] += pool.num_connections
+            host_stats['hits'] += max(pool.num_requests - pool.num_connections, 0)
+
+    return stats
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_session)
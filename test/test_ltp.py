@@ -1,6 +1,6 @@
 import logging
 import unittest
-from unittest.mock import Mock
+from unittest.mock import MagicMock, Mock, patch
 from ltp import LtpLogs
 
 TEST_LOG = """
@@ -21,6 +21,21 @@ class LtpLogsPluginTest(unittest.TestCase):
     def setUp(self):
         self.plugin = LtpLogs()
 
+        test_patcher = patch("ltp.Test")
+        self.test_model_mock = test_patcher.start()
+        self.addCleanup(test_patcher.stop)
+
+        transaction_patcher = patch("ltp.transaction")
+        transaction_patcher.start()
+        self.addCleanup(transaction_patcher.stop)
+
+    def mock_failed_tests(self, testrun, tests):
+        testrun.tests = MagicMock()
+        testrun.tests.filter.return_value.select_related.return_value.only.return_value.iterator.return_value = tests
+
+    def assert_saved_tests(self, tests):
+        self.test_model_mock.objects.bulk_update.assert_called_once_with(tests, ['log'], batch_size=500)
+
     def test_postprocess_testrun(self):
         test_1 = Mock()
         test_1.id = 1
@@ -43,22 +58,21 @@ class LtpLogsPluginTest(unittest.TestCase):
         testrun = Mock()
         testrun.log_file = TEST_LOG
 
-        testrun.tests = Mock()
-        testrun.tests.filter.return_value = [test_1, test_2, test_3]
+        self.mock_failed_tests(testrun, [test_1, test_2, test_3])
 
         self.plugin.postprocess_testrun(testrun)
         testrun.tests.filter.assert_called_with(result=False)
 
         self.assertEqual("the log 1\ntest_1: some log 1\ntest_1: some log 2\ntest_1: some log 3", test_1.log)
-        test_1.save.assert_called_with()
 
         # Test 2 is not in the logs
         self.assertEqual("the log 2", test_2.log)
-        test_2.save.assert_not_called()
 
         # Test 3 didn't have any logs
         self.assertEqual("test_3: some log 1\ntest_3: some log 2\ntest_3: some log 3", test_3.log)
-        test_3.save.assert_called_with()
+
+        # Only tests 1 and 3 got their logs updated
+        self.assert_saved_tests([test_1, test_3])
 
     def test_tests_with_regex_characters(self):
         test = Mock()
@@ -69,14 +83,26 @@ class LtpLogsPluginTest(unittest.TestCase):
         testrun = Mock()
         testrun.log_file = TEST_LOG
 
-        testrun.tests = Mock()
-        testrun.tests.filter.return_value = [test]
+        self.mock_failed_tests(testrun, [test])
 
         self.plugin.postprocess_testrun(testrun)
 
         self.assertEqual("the log\ntest[a-1]: some log", test.log)
 
-        test.save.assert_called_with()
+        self.assert_saved_tests([test])
+
+    def test_no_logs_found(self):
+        test = Mock()
+        test.id = 1
+        test.name = "test_2"
+        test.log = None
+
+        testrun = Mock()
+        testrun.log_file = TEST_LOG
+        self.mock_failed_tests(testrun, [test])
+
+        self.plugin.postprocess_testrun(testrun)
+        self.test_model_mock.objects.bulk_update.assert_not_called()
 
 
 if __name__ == "__main__":
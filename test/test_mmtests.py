@@ -1,6 +1,8 @@
 import logging
 import unittest
-from unittest.mock import MagicMock
+import requests
+from unittest.mock import MagicMock, patch
+from squad.ci.exceptions import TemporaryFetchIssue
 
 from mmtests import Mmtests
 
@@ -25,6 +27,7 @@ class MmtestsPluginTest(unittest.TestCase):
         testjob.job_id = "TEST:mygroup@myproject#123"
 
         tuxsuite = MagicMock()
+        tuxsuite.__resolve_settings__ = MagicMock(return_value={"TUXSUITE_TOKEN": "secret"})
         tuxsuite.job_url = MagicMock(
             return_value="https://tuxapi.tuxsuite.com/v1/groups/mygroup/projects/myproject/tests/123/"
         )
@@ -34,7 +37,7 @@ class MmtestsPluginTest(unittest.TestCase):
         attachments_url = "https://storage.tuxsuite.com/public/mygroup/myproject/tests/123/attachments/"
         attachment_file_url = f"{attachments_url}{filename}"
 
-        def request_mock(url):
+        def request_mock(url, headers=None):
             response = MagicMock()
             response.status_code = 200
 
@@ -51,7 +54,11 @@ class MmtestsPluginTest(unittest.TestCase):
 
             return response
 
-        tuxsuite.fetch_url = request_mock
+        session = MagicMock()
+        session.get = request_mock
+        session_patcher = patch("mmtests.get_session", return_value=session)
+        session_patcher.start()
+        self.addCleanup(session_patcher.stop)
 
         backend = MagicMock()
         backend.implementation_type = "tuxsuite"
@@ -69,6 +76,7 @@ class MmtestsPluginTest(unittest.TestCase):
         self.testrun_mock = testrun
         self.backend_mock = backend
         self.tuxsuite_mock = tuxsuite
+        self.session_mock = session
         self.testjob_mock = testjob
 
     def test_tuxsuite_only(self):
@@ -84,23 +92,42 @@ class MmtestsPluginTest(unittest.TestCase):
     def test_bad_storage_request(self):
         bad_request = MagicMock()
         bad_request.status_code = 400
-        self.tuxsuite_mock.fetch_url = MagicMock(return_value=bad_request)
+        self.session_mock.get = MagicMock(return_value=bad_request)
 
         self.plugin.postprocess_testjob(self.testjob_mock)
-        self.tuxsuite_mock.fetch_url.assert_called_with(self.attachments_url)
+        self.session_mock.get.assert_called_with(self.attachments_url, headers={"Authorization": "secret"})
         self.attachments_mock.create.assert_not_called()
 
     def test_missing_json_keys(self):
         bad_request = MagicMock()
         bad_request.status_code = 200
         bad_request.json = MagicMock(return_value={})
-        self.tuxsuite_mock.fetch_url = MagicMock(return_value=bad_request)
+        self.session_mock.get = MagicMock(return_value=bad_request)
 
         self.plugin.postprocess_testjob(self.testjob_mock)
-        self.tuxsuite_mock.fetch_url.assert_called_with(self.attachments_url)
+        self.session_mock.get.assert_called_with(self.attachments_url, headers={"Authorization": "secret"})
         self.attachments_mock.create.assert_not_called()
 
     def test_attachments_created(self):
         self.plugin.postprocess_testjob(self.testjob_mock)
         self.attachments_mock.create.assert_called_with(filename=self.filename_mock, length=len(self.content_mock))
         self.attachment_mock.save_file.assert_called_with(self.filename_mock, self.content_mock)
+
+    def test_auth_header(self):
+        self.session_mock.get = MagicMock(wraps=self.session_mock.get)
+        self.plugin.postprocess_testjob(self.testjob_mock)
+        self.tuxsuite_mock.__resolve_settings__.assert_called_with(self.testjob_mock)
+        for call in self.session_mock.get.call_args_list:
+            self.assertEqual({"Authorization": "secret"}, call.kwargs["headers"])
+
+    def test_no_token(self):
+        self.tuxsuite_mock.__resolve_settings__.return_value = {}
+        self.session_mock.get = MagicMock(wraps=self.session_mock.get)
+        self.plugin.postprocess_testjob(self.testjob_mock)
+        self.session_mock.get.assert_called_with(self.attachment_file_url, headers={})
+
+    def test_fetch_issue(self):
+        self.session_mock.get = MagicMock(side_effect=requests.exceptions.ConnectionError("boom"))
+        with self.assertRaises(TemporaryFetchIssue):
+            self.plugin.postprocess_testjob(self.testjob_mock)
+        self.attachments_mock.create.assert_not_called()
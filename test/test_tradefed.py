@@ -1,13 +1,30 @@
 import os
+import errno
+import gzip
+import json
 import logging
+import requests
 import requests_mock
 import tarfile
+import tempfile
 import unittest
+import xml.etree.ElementTree as ET
+from django.test import override_settings
 from io import StringIO, BytesIO
-from unittest.mock import PropertyMock, MagicMock, Mock, patch
+from celery.exceptions import Retry
+from unittest.mock import PropertyMock, MagicMock, Mock, ANY, call, patch
+from squad.core.models import Test, TestRun
 from tradefed import Tradefed, ResultFiles, ExtractedResult
-from tradefed.tasks import update_build_status
-from collections import defaultdict
+from tradefed.cache import ArtifactCache
+from tradefed.scratch import HEADER, decode_tests, encode_testcases
+from tradefed.suites import SuiteCache
+from tradefed.filters import ModuleFilter
+from tradefed.loader import copy_tests
+from tradefed.progress import PROGRESS_METADATA_KEY, finish_progress, progress_metadata, record_progress
+from tradefed.http import ResumeRestarted, conditional_get, iter_resumable_content
+from squadplugins.http import get_pool_stats, get_session, reset_session
+from tradefed.tasks import create_lane, create_testcase_tests, create_testcase_tests_from_range, create_tests, get_or_create_test_metadata, ingest_chunks, ingest_lane, ingestion_slot, parse_tests_range, reapply_passes, record_status_counters, update_build_status
+from collections import OrderedDict, defaultdict
 
 
 SUITES = """
@@ -476,18 +493,33 @@ actions:
 
 logger = logging.getLogger()
 logger.setLevel(logging.ERROR)
-knownissue = None
 
 
 class TradefedLogsPluginTest(unittest.TestCase):
     def setUp(self):
         self.plugin = Tradefed()
+
+        test_patcher = patch("tradefed.Test")
+        self.test_model_mock = test_patcher.start()
+        self.addCleanup(test_patcher.stop)
+
+        transaction_patcher = patch("tradefed.transaction")
+        transaction_patcher.start()
+        self.addCleanup(transaction_patcher.stop)
+
         self.tarfile_path = os.path.abspath("./test/test_output.tar.xz")
         self.tarfile = open(self.tarfile_path, "rb")
 
     def tearDown(self):
         self.tarfile.close()
 
+    def saved_tests(self):
+        saved = []
+        for args, kwargs in self.test_model_mock.objects.bulk_update.call_args_list:
+            self.assertEqual((['log'],), args[1:])
+            saved += args[0]
+        return saved
+
     @patch("tradefed.Tradefed._extract_cts_results")
     @patch("tradefed.Tradefed._create_testrun_attachment")
     @patch("tradefed.Tradefed._assign_test_log")
@@ -571,6 +603,73 @@ class TradefedLogsPluginTest(unittest.TestCase):
         get_tradefed_url_from_tuxsuite_mock.assert_called()
         download_results_mock.assert_called()
 
+    @patch("tradefed.Tradefed._get_tradefed_url_from_tuxsuite", Mock(return_value="http://tradefed.url"))
+    @patch("tradefed.Tradefed.tradefed_results_url", new_callable=PropertyMock, return_value="http://foo.com")
+    @patch("tradefed.Tradefed._convert_paths", Mock())
+    @patch("tradefed.Tradefed._create_testrun_attachment", Mock())
+    @patch("tradefed.Tradefed._download_results")
+    @patch("tradefed.Tradefed._extract_cts_results")
+    def test_postprocess_testjob_publishes_summary(self, extract_cts_results_mock, download_results_mock, results_url_mock):
+        results = ResultFiles()
+        results.test_results = ExtractedResult()
+        results.test_results.contents = BytesIO(XML_RESULTS.encode())
+        download_results_mock.return_value = results
+
+        testjob_mock = MagicMock()
+        testjob_mock.job_id = "1234"
+        testjob_mock.backend.implementation_type = "tuxsuite"
+        testjob_mock.testrun.metadata = {}
+        settings = {"PLUGINS_TRADEFED_EXTRACT_AGGREGATED": True}
+        testjob_mock.target.get_setting.side_effect = lambda key, default=None: settings.get(key, default)
+
+        def extract_cts_results(buf, *args):
+            # Totals are saved before the tests are extracted
+            testjob_mock.testrun.save.assert_called_with()
+            self.assertEqual(0, buf.tell())
+
+        extract_cts_results_mock.side_effect = extract_cts_results
+        self.plugin.postprocess_testjob(testjob_mock)
+
+        metadata = testjob_mock.testrun.metadata
+        self.assertEqual({"pass": 3, "failed": 2, "modules_done": 1, "modules_total": 1}, metadata["tradefed_summary_1234"])
+        self.assertEqual({
+            "arm64-v8a.module_foo": {"pass": 1, "done": "true"},
+            "arm64-v8a.module_bar": {"pass": 1, "done": "true"},
+        }, metadata["tradefed_modules_1234"])
+        extract_cts_results_mock.assert_called_once()
+
+    @patch("tradefed.Tradefed._get_tradefed_url_from_tuxsuite", Mock(return_value="http://tradefed.url"))
+    @patch("tradefed.Tradefed._convert_paths", Mock())
+    @patch("tradefed.Tradefed._create_testrun_attachment", Mock())
+    @patch("tradefed.Tradefed._download_results")
+    @patch("tradefed.Tradefed._extract_cts_results")
+    def test_postprocess_testjob_clamps_chunk_settings(self, extract_cts_results_mock, download_results_mock):
+        results = ResultFiles()
+        results.test_results = ExtractedResult()
+        results.test_results.contents = BytesIO(XML_RESULTS.encode())
+        download_results_mock.return_value = results
+
+        testjob_mock = MagicMock()
+        testjob_mock.backend.implementation_type = "tuxsuite"
+        settings = {
+            "PLUGINS_TRADEFED_EXTRACT_AGGREGATED": True,
+            "PLUGINS_TRADEFED_MAX_CHUNKS_IN_FLIGHT": 0,
+            "PLUGINS_TRADEFED_CHUNK_MAX_TESTS": 0,
+            "PLUGINS_TRADEFED_CHUNK_MAX_BYTES": -1,
+        }
+        testjob_mock.target.get_setting.side_effect = lambda key, default=None: settings.get(key, default)
+
+        self.plugin.postprocess_testjob(testjob_mock)
+        self.assertEqual((1, 1, 1), extract_cts_results_mock.call_args[0][3:6])
+
+    def test_read_summary_truncated(self):
+        xml = XML_RESULTS.encode()
+        buf = BytesIO(xml[:xml.index(b'<Module name="module_bar"') + 10])
+        summary, modules = self.plugin._read_summary(buf)
+        self.assertEqual(3, summary["pass"])
+        self.assertEqual(["arm64-v8a.module_foo"], list(modules.keys()))
+        self.assertEqual(0, buf.tell())
+
     @patch("tradefed.Tradefed._create_testrun_attachment")
     @patch("tradefed.Tradefed._assign_test_log")
     @patch("tradefed.Tradefed._get_from_artifactorial")
@@ -703,6 +802,31 @@ class TradefedLogsPluginTest(unittest.TestCase):
         self.plugin._create_testrun_attachment(testrun_mock, name, extracted_file_mock, "text/plain")
         testrun_mock.attachments.create.assert_called_with(filename='name', length=2, mimetype='text/plain')
 
+    @override_settings(PLUGINS_TRADEFED_SPOOL_MAX_SIZE=1024)
+    def test_create_testrun_attachment_streams_spool(self):
+        testrun_mock = Mock()
+        spool = tempfile.SpooledTemporaryFile(max_size=1024)
+        spool.write(b"x" * 4096)
+        extracted_file = ExtractedResult()
+        extracted_file.contents = spool
+        extracted_file.length = 4096
+
+        sizes = []
+        read = spool.read
+
+        def read_spy(*args):
+            sizes.append(args)
+            return read(*args)
+
+        saved = []
+        testrun_mock.attachments.create.return_value.save_file.side_effect = lambda name, file: saved.append(b"".join(file.chunks(chunk_size=1024)))
+        with patch.object(spool, "read", read_spy):
+            self.plugin._create_testrun_attachment(testrun_mock, "tradefed.tar.xz", extracted_file, "application/x-tar")
+
+        self.assertEqual([b"x" * 4096], saved)
+        self.assertNotIn((), sizes)
+        spool.close()
+
     @patch("tradefed.Tradefed._download_results")
     def test_get_from_artifactorial(self, download_results_mock):
         suite_name = "2_bar"
@@ -722,6 +846,20 @@ class TradefedLogsPluginTest(unittest.TestCase):
         testjob_mock.backend.get_implementation().proxy.results.get_testsuite_results_yaml.assert_called_with(999, '2_bar', 500, 0)
         self.assertIsNotNone(result)
 
+    def test_get_testsuite_results_pages_multicall(self):
+        page = "[{name: test1}, {name: test2}]"
+        short_page = "[{name: test-attachment}]"
+        proxy = Mock()
+        proxy.system.multicall.return_value = [[page], [short_page], ["[]"], ["[]"]]
+
+        pages = list(self.plugin._Tradefed__get_testsuite_results_pages(proxy, 999, "2_bar", 2, 2))
+        self.assertEqual([[{"name": "test1"}, {"name": "test2"}], [{"name": "test-attachment"}]], pages)
+        proxy.system.multicall.assert_called_once_with([
+            {"methodName": "results.get_testsuite_results_yaml", "params": (999, "2_bar", 2, offset)}
+            for offset in [2, 4, 6, 8]
+        ])
+        proxy.results.get_testsuite_results_yaml.assert_not_called()
+
     @patch("tradefed.Tradefed._download_results")
     def test_get_from_artifactorial_invalid_suite_list(self, download_results_mock):
         suite_name = "2_bar"
@@ -817,6 +955,50 @@ class TradefedLogsPluginTest(unittest.TestCase):
         testjob_mock.backend.get_implementation().proxy.results.get_testsuite_results_yaml.assert_called_with(999, '2_bar', 500, 0)
         self.assertIsNone(result)
 
+    def test_get_paginated_objects(self):
+        url = "http://lava.server/api/v0.2/jobs/999/suites/"
+        lava_implementation = Mock()
+        lava_implementation.authentication = {"Authorization": "Token abc"}
+
+        with requests_mock.Mocker() as fake_request:
+            for offset in [0, 2, 4]:
+                next_url = f"{url}?limit=2&offset={offset + 2}" if offset < 4 else None
+                fake_request.get(
+                    f"{url}?limit=2&offset={offset}",
+                    status_code=200,
+                    json={"count": 5, "next": next_url, "results": [{"id": i} for i in range(offset, min(offset + 2, 5))]},
+                )
+
+            objects = self.plugin._Tradefed__get_paginated_objects(f"{url}?limit=2&offset=0", lava_implementation)
+            self.assertEqual([{"id": i} for i in range(5)], list(objects))
+            self.assertEqual(3, fake_request.call_count)
+            self.assertEqual("Token abc", fake_request.last_request.headers["Authorization"])
+
+    def test_get_from_artifactorial_rest(self):
+        api_url = "http://lava.server/api/v0.2/"
+        testjob_mock = Mock()
+        testjob_mock.job_id = 999
+        lava_implementation = testjob_mock.backend.get_implementation()
+        lava_implementation.use_xml_rpc = False
+        lava_implementation.api_url_base = api_url
+        lava_implementation.authentication = {}
+
+        with requests_mock.Mocker() as fake_request, \
+                patch("tradefed.Tradefed._download_results") as download_results_mock:
+            fake_request.get(
+                f"{api_url}jobs/999/suites/?name__contains=2_bar",
+                status_code=200,
+                json={"count": 1, "next": None, "results": [{"id": 1, "name": "2_bar"}]},
+            )
+            fake_request.get(
+                f"{api_url}jobs/999/suites/1/tests/?name=test-attachment",
+                status_code=200,
+                json={"results": [{"metadata": "{reference: 'http://foo.bar.com'}"}]},
+            )
+
+            self.plugin._get_from_artifactorial(testjob_mock, "2_bar")
+            download_results_mock.assert_called_with(RESULT_URL)
+
     def test_download_results(self):
         with requests_mock.Mocker() as fake_request:
             fake_request.get(
@@ -833,7 +1015,105 @@ class TradefedLogsPluginTest(unittest.TestCase):
             self.assertIsNotNone(results.tradefed_stdout)
             self.assertIsNotNone(results.tradefed_logcat)
 
-    @patch("tarfile.TarFile.getmembers")
+    def test_download_results_members_readable(self):
+        with requests_mock.Mocker() as fake_request:
+            fake_request.get(
+                "http://foo.bar.com",
+                status_code=200,
+                content=self.tarfile.read(),
+                headers={"Content-Type": "application/x-tar"},
+            )
+
+            results = self.plugin._download_results(RESULT_URL)
+            self.assertEqual(29931, results.test_results.length)
+            self.assertEqual(29931, len(results.test_results.contents.read()))
+            self.assertEqual(13904, len(results.test_result_xslt.contents.read()))
+            self.assertEqual(3863, len(results.test_result_image.contents.read()))
+            self.assertEqual(9407, len(results.tradefed_logcat.contents.read()))
+
+    @override_settings(PLUGINS_TRADEFED_SPOOL_MAX_SIZE=1024)
+    def test_download_results_spooled_to_disk(self):
+        content = self.tarfile.read()
+        with requests_mock.Mocker() as fake_request:
+            fake_request.get(
+                "http://foo.bar.com",
+                status_code=200,
+                content=content,
+                headers={"Content-Type": "application/x-tar"},
+            )
+
+            results = self.plugin._download_results(RESULT_URL)
+            self.assertIsInstance(results.tradefed_zipfile.contents, tempfile.SpooledTemporaryFile)
+            self.assertTrue(results.tradefed_zipfile.contents._rolled)
+            self.assertEqual(len(content), results.tradefed_zipfile.length)
+            self.assertIsNotNone(results.test_results)
+
+    def test_download_results_cached(self):
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                override_settings(PLUGINS_TRADEFED_CACHE_DIR=cache_dir), \
+                requests_mock.Mocker() as fake_request:
+            fake_request.get(
+                "http://foo.bar.com",
+                status_code=200,
+                content=self.tarfile.read(),
+                headers={"Content-Type": "application/x-tar", "ETag": '"abc"'},
+            )
+
+            results = self.plugin._download_results(RESULT_URL)
+            self.assertEqual(1, fake_request.call_count)
+            self.assertIsNotNone(results.test_results)
+            results.tradefed_zipfile.contents.close()
+
+            results = self.plugin._download_results(RESULT_URL)
+            self.assertEqual(1, fake_request.call_count)
+            self.assertIsNotNone(results.test_results)
+            self.assertEqual("application/x-tar", results.tradefed_zipfile.mimetype)
+            results.tradefed_zipfile.contents.close()
+
+    def test_download_results_cache_unreadable(self):
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                override_settings(PLUGINS_TRADEFED_CACHE_DIR=cache_dir), \
+                patch("tradefed.cache.ArtifactCache.get", side_effect=PermissionError("denied")), \
+                requests_mock.Mocker() as fake_request:
+            fake_request.get("http://foo.bar.com", status_code=200, content=self.tarfile.read())
+
+            results = self.plugin._download_results(RESULT_URL)
+            self.assertEqual(1, fake_request.call_count)
+            self.assertIsNotNone(results.test_results)
+            self.assertIsInstance(results.tradefed_zipfile.contents, tempfile.SpooledTemporaryFile)
+
+    def test_download_results_cache_full(self):
+        def put(url, chunks, **attrs):
+            next(iter(chunks))
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                override_settings(PLUGINS_TRADEFED_CACHE_DIR=cache_dir), \
+                patch("tradefed.cache.ArtifactCache.put", side_effect=put), \
+                requests_mock.Mocker() as fake_request:
+            fake_request.get("http://foo.bar.com", status_code=200, content=self.tarfile.read())
+
+            results = self.plugin._download_results(RESULT_URL)
+            self.assertEqual(2, fake_request.call_count)
+            self.assertIsNotNone(results.test_results)
+            self.assertIsInstance(results.tradefed_zipfile.contents, tempfile.SpooledTemporaryFile)
+
+    @patch("tradefed.Tradefed._create_testrun_attachment", Mock())
+    @patch("tradefed.Tradefed._download_results")
+    @patch("tradefed.Tradefed._get_tradefed_url_from_tuxsuite", Mock(return_value=RESULT_URL))
+    @patch("tradefed.update_testjob_status.delay", Mock())
+    def test_postprocess_testjob_closes_tarball(self, download_results_mock):
+        result_files = ResultFiles()
+        result_files.tradefed_zipfile = ExtractedResult()
+        result_files.tradefed_zipfile.contents = BytesIO(b"tarball")
+        download_results_mock.return_value = result_files
+
+        testjob_mock = MagicMock()
+        type(testjob_mock.backend).implementation_type = PropertyMock(return_value="tuxsuite")
+        self.plugin.postprocess_testjob(testjob_mock)
+        self.assertTrue(result_files.tradefed_zipfile.contents.closed)
+
+    @patch("tarfile.TarFile.next")
     def test_download_results_short_file(self, tarfile_mock):
         tarfile_mock.side_effect = EOFError()
 
@@ -851,7 +1131,7 @@ class TradefedLogsPluginTest(unittest.TestCase):
             self.assertIsNone(results.tradefed_stdout)
             self.assertIsNone(results.tradefed_logcat)
 
-    @patch("tarfile.TarFile.getmembers")
+    @patch("tarfile.TarFile.next")
     def test_download_results_corrupted_compression_readerror(self, tarfile_mock):
         tarfile_mock.side_effect = tarfile.ReadError()
 
@@ -869,7 +1149,7 @@ class TradefedLogsPluginTest(unittest.TestCase):
             self.assertIsNone(results.tradefed_stdout)
             self.assertIsNone(results.tradefed_logcat)
 
-    @patch("tarfile.TarFile.getmembers")
+    @patch("tarfile.TarFile.next")
     def test_download_results_corrupted_compression_headererror(self, tarfile_mock):
         tarfile_mock.side_effect = tarfile.HeaderError()
 
@@ -979,7 +1259,9 @@ class TradefedLogsPluginTest(unittest.TestCase):
     @patch("tradefed.settings")
     def test_download_results_from_squad(self, mock_settings, mock_testrun):
         attachment = MagicMock()
-        attachment.data = b"1"
+        # The tarball is streamed from storage, never loaded whole
+        type(attachment).data = PropertyMock(side_effect=AssertionError("attachment.data must not be read"))
+        attachment.storage.open.return_value.__enter__.return_value = BytesIO(b"1")
         attachment.mimetype.return_value = "text/plain"
         attachment.filename.return_value = "tradefed.tar.xz"
 
@@ -1002,13 +1284,130 @@ class TradefedLogsPluginTest(unittest.TestCase):
 
         mock_testrun.objects = objects
         mock_settings.BASE_URL = "http://squad.com"
+        mock_settings.PLUGINS_TRADEFED_SPOOL_MAX_SIZE = 1024
 
         url = "http://squad.com/api/testruns/1/attachments?filename=tradefed.tar.xz"
         results = self.plugin._download_results(url)
         self.assertEqual(self.plugin.tradefed_results_url, url)
+        attachment.storage.open.assert_called_once_with('rb')
+        self.assertEqual(1, results.tradefed_zipfile.length)
         results.tradefed_zipfile.contents.seek(0)
         self.assertEqual(b"1", results.tradefed_zipfile.contents.read())
 
+    def test_artifact_cache_evicts_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ArtifactCache(cache_dir, max_size=10)
+            contents, entry = cache.put("http://a", [b"aaaaaa"], etag='"a"')
+            contents.close()
+            self.assertEqual(6, entry["length"])
+            self.assertEqual('"a"', entry["etag"])
+
+            os.utime(os.path.join(cache_dir, "objects", entry["digest"]), (0, 0))
+            contents, _ = cache.put("http://b", [b"bbb", b"bbb"])
+            contents.close()
+
+            self.assertIsNone(cache.get("http://a"))
+            contents, entry = cache.get("http://b")
+            self.assertEqual(b"bbbbbb", contents.read())
+            contents.close()
+
+    def test_conditional_get_not_modified(self):
+        url = "http://lava.server/api/v0.2/jobs/1/suites/"
+        with requests_mock.Mocker() as fake_request:
+            fake_request.get(url, [
+                {"status_code": 200, "content": b'{"results": []}', "headers": {"ETag": '"v1"'}},
+                {"status_code": 304},
+            ])
+
+            first = conditional_get(get_session(), url)
+            second = conditional_get(get_session(), url)
+            self.assertEqual('"v1"', fake_request.request_history[1].headers["If-None-Match"])
+            self.assertEqual(200, second.status_code)
+            self.assertEqual(first.json(), second.json())
+
+    @patch("tradefed.http.CONDITIONAL_CACHE_MAX_ENTRY_BYTES", 8)
+    @patch("tradefed.http.CONDITIONAL_CACHE_MAX_BYTES", 10)
+    def test_conditional_get_cache_bytes(self):
+        with patch("tradefed.http.__conditional_cache__", OrderedDict()) as cache, \
+                patch("tradefed.http.__conditional_cache_bytes__", 0), \
+                requests_mock.Mocker() as fake_request:
+            for url, content in [("http://a", b"aaaaaa"), ("http://b", b"bbbbbb"), ("http://c", b"c" * 20)]:
+                fake_request.get(url, status_code=200, content=content, headers={"ETag": '"v1"'})
+                conditional_get(get_session(), url)
+
+            # a is evicted to keep b under the byte limit, c is too big to keep
+            self.assertEqual(["http://b"], [key[0] for key in cache.keys()])
+
+    @override_settings(PLUGINS_HTTP_POOL_SIZES={"lava.server": 4})
+    def test_get_session_per_host_pools(self):
+        reset_session()
+        session = get_session()
+        self.assertIs(session, get_session())
+        self.assertEqual(4, session.get_adapter("https://lava.server/api/").poolmanager.connection_pool_kw["maxsize"])
+        self.assertEqual(20, session.get_adapter("https://storage.tuxsuite.com/public/").poolmanager.connection_pool_kw["maxsize"])
+
+        with patch("squadplugins.http.os.getpid", return_value=-1):
+            self.assertIsNot(session, get_session())
+        reset_session()
+
+    def test_get_pool_stats(self):
+        reset_session()
+        self.assertEqual({}, get_pool_stats())
+        adapter = get_session().get_adapter("http://lava.server/")
+        pool = adapter.poolmanager.connection_from_url("http://lava.server/")
+        pool.num_requests = 3
+        pool.num_connections = 1
+        self.assertEqual({"lava.server": {"requests": 3, "hits": 2, "misses": 1}}, get_pool_stats())
+        reset_session()
+
+    def test_iter_resumable_content(self):
+        def interrupted(chunk_size):
+            yield b"abc"
+            raise requests.exceptions.ChunkedEncodingError()
+
+        response = Mock()
+        response.url = RESULT_URL
+        response.headers = {"ETag": '"v1"'}
+        response.iter_content = interrupted
+
+        resumed = Mock()
+        resumed.status_code = 206
+        resumed.headers = {"Content-Range": "bytes 3-5/6"}
+        resumed.iter_content.return_value = [b"def"]
+
+        session = Mock()
+        session.get.return_value = resumed
+
+        self.assertEqual(b"abcdef", b"".join(iter_resumable_content(session, response, 3)))
+        session.get.assert_called_with(RESULT_URL, headers={"Range": "bytes=3-", "If-Range": '"v1"'}, stream=True)
+
+    def test_iter_resumable_content_not_resumable(self):
+        def interrupted(chunk_size):
+            yield b"abc"
+            raise requests.exceptions.ChunkedEncodingError()
+
+        resumed = Mock()
+        resumed.status_code = 206
+        resumed.headers = {"Content-Range": "bytes 0-5/6"}
+        resumed.iter_content.return_value = [b"abcdef"]
+
+        reasons = ["no ETag or Last-Modified", "gzip encoded", "resumed at bytes 0-5/6 instead of byte 3"]
+        for headers in [{}, {"ETag": '"v1"', "Content-Encoding": "gzip"}, {"ETag": '"v1"'}]:
+            response = Mock()
+            response.url = RESULT_URL
+            response.headers = headers
+            response.iter_content = interrupted
+
+            session = Mock()
+            session.get.return_value = resumed
+
+            with self.assertRaises(ResumeRestarted) as raised:
+                b"".join(iter_resumable_content(session, response, 3))
+            self.assertIn(reasons.pop(0), str(raised.exception))
+
+            # Only the last one, with a validator and no encoding, tries to resume
+            self.assertEqual("ETag" in headers and "Content-Encoding" not in headers, session.get.called)
+
     def test_assign_test_log(self):
         test_mock = Mock()
         suite_mock = PropertyMock(return_value="cts-lkft/arm64-v8a.module_foo")
@@ -1017,7 +1416,75 @@ class TradefedLogsPluginTest(unittest.TestCase):
         type(test_mock).name = name_mock
         self.plugin._assign_test_log(StringIO(XML_RESULTS), [test_mock])
         self.assertIn("java.lang.Error", test_mock.log)
-        test_mock.save.assert_called_once_with()
+        self.assertEqual([test_mock], self.saved_tests())
+
+    def test_assign_test_log_many_tests(self):
+        tests = []
+        for suite, name in [
+            ("cts-lkft/arm64-v8a.module_foo", "TestCaseBar.test_bar4"),
+            ("cts-lkft/arm64-v8a.module_bar", "TestCaseFoo.test_bar4"),
+            ("cts-lkft/module_bar", "TestCaseFoo.ztestSetAndGetBrightnessConfiguration"),
+            ("cts-lkft/arm64-v8a.module_bar", 'TestCaseFoo.test_"quoted"'),
+        ]:
+            test_mock = Mock()
+            type(test_mock).suite = PropertyMock(return_value=suite)
+            type(test_mock).name = PropertyMock(return_value=name)
+            tests.append(test_mock)
+
+        self.plugin._assign_test_log(StringIO(XML_RESULTS), tests)
+        self.assertIn("java.lang.Error", tests[0].log)
+        self.assertIn("java.lang.Error", tests[1].log)
+        self.assertIn("AssumptionViolatedException", tests[2].log)
+        self.assertEqual(tests[:3], self.saved_tests())
+
+    def test_assign_test_log_streaming(self):
+        tests = []
+        for suite, name in [
+            ("cts-lkft/arm64-v8a.module_foo", "TestCaseBar.test_bar4"),
+            ("cts-lkft/arm64-v8a.module_foo/TestCaseBar.first_subname/second_subname.third_subname", "test_bar5_64bit"),
+            ("cts-lkft/module_bar", "TestCaseFoo.ztestSetAndGetBrightnessConfiguration"),
+            ("cts-lkft/arm64-v8a.module_foo", "TestCaseBar.test_bar5"),
+            ("cts-lkft/arm64-v8a.module_foo1", "TestCaseBar.test_bar4"),
+        ]:
+            test_mock = Mock()
+            type(test_mock).suite = PropertyMock(return_value=suite)
+            type(test_mock).name = PropertyMock(return_value=name)
+            tests.append(test_mock)
+
+        buf = StringIO(XML_RESULTS)
+        self.plugin._assign_test_log(buf, tests, streaming=True)
+        self.assertEqual(0, buf.tell())
+        self.assertIn("java.lang.Error", tests[0].log)
+        self.assertIn("java.lang.Error", tests[1].log)
+        self.assertIn("AssumptionViolatedException", tests[2].log)
+        self.assertEqual(tests[:3], self.saved_tests())
+
+    def test_assign_test_log_streaming_releases_elements(self):
+        iterparse = ET.iterparse
+        sizes = []
+
+        def iterparse_spy(*args, **kwargs):
+            for event, element in iterparse(*args, **kwargs):
+                if event == 'end' and element.tag == 'Module':
+                    # Finished TestCases are no longer attached to their Module
+                    sizes.append(len(element))
+                yield event, element
+
+        test_mock = Mock()
+        type(test_mock).suite = PropertyMock(return_value="cts-lkft/arm64-v8a.module_foo")
+        type(test_mock).name = PropertyMock(return_value="TestCaseBar.test_bar4")
+        with patch("tradefed.ET.iterparse", iterparse_spy):
+            self.plugin._assign_test_log(StringIO(XML_RESULTS), [test_mock], streaming=True)
+
+        self.assertIn("java.lang.Error", test_mock.log)
+        self.assertTrue(len(sizes) > 0)
+        self.assertEqual([0] * len(sizes), sizes)
+
+    @override_settings(PLUGINS_BULK_UPDATE_BATCH_SIZE=2)
+    def test_save_test_logs_batch_size(self):
+        tests = [Mock(), Mock(), Mock()]
+        self.plugin._save_test_logs(tests)
+        self.test_model_mock.objects.bulk_update.assert_called_once_with(tests, ['log'], batch_size=2)
 
     def test_assign_test_log_no_slash(self):
         test_mock = Mock()
@@ -1026,7 +1493,7 @@ class TradefedLogsPluginTest(unittest.TestCase):
         name_mock = PropertyMock(return_value="TestCaseBar.test_bar4")
         type(test_mock).name = name_mock
         self.plugin._assign_test_log(StringIO(XML_RESULTS), [test_mock])
-        test_mock.save.assert_not_called()
+        self.assertEqual([], self.saved_tests())
 
     def test_assign_test_log_complex_name(self):
         test_mock = Mock()
@@ -1036,7 +1503,7 @@ class TradefedLogsPluginTest(unittest.TestCase):
         type(test_mock).name = name_mock
         self.plugin._assign_test_log(StringIO(XML_RESULTS), [test_mock])
         self.assertIn("java.lang.Error", test_mock.log)
-        test_mock.save.assert_called_once_with()
+        self.assertEqual([test_mock], self.saved_tests())
 
     def test_assign_test_log_empty_list(self):
         buf = StringIO(XML_RESULTS)
@@ -1050,7 +1517,7 @@ class TradefedLogsPluginTest(unittest.TestCase):
         name_mock = PropertyMock(return_value="TestCaseBar.test_bar5")
         type(test_mock).name = name_mock
         self.plugin._assign_test_log(StringIO(XML_RESULTS), [test_mock])
-        test_mock.save.assert_not_called()
+        self.assertEqual([], self.saved_tests())
 
     def test_assign_test_log_missing_xml(self):
         test_mock = Mock()
@@ -1059,7 +1526,7 @@ class TradefedLogsPluginTest(unittest.TestCase):
         name_mock = PropertyMock(return_value="TestCaseBar.test_bar5")
         type(test_mock).name = name_mock
         self.plugin._assign_test_log(StringIO(), [test_mock])
-        test_mock.save.assert_not_called()
+        self.assertEqual([], self.saved_tests())
 
     def test_assign_test_log_missing_module(self):
         test_mock = Mock()
@@ -1068,7 +1535,7 @@ class TradefedLogsPluginTest(unittest.TestCase):
         name_mock = PropertyMock(return_value="TestCaseBar.test_bar5")
         type(test_mock).name = name_mock
         self.plugin._assign_test_log(StringIO(XML_RESULTS), [test_mock])
-        test_mock.save.assert_not_called()
+        self.assertEqual([], self.saved_tests())
 
     def test_extract_results_correctly(self):
         testrun = Mock()
@@ -1083,46 +1550,39 @@ class TradefedLogsPluginTest(unittest.TestCase):
         def chord_mock_func(task):
             return chord_mock_return_func
 
-        def update_s(testrun_pk, job_id, job_status):
+        def update_s(testrun_pk, job_id, job_status, context_id=None):
             return {}
 
-        def goc_mock(*args, **kwargs):
-            return kwargs, False
+        known_issues = {}
 
-        class KnownIssueMock:
-            def __init__(self, title, test_name):
-                self.environments = set()
-                self.title = title
-                self.test_name = test_name
-                self.saved = False
-
-            def save(self):
-                self.saved = True
-
-        def goc_knownissues(*args, **kwargs):
-            global knownissue
-            knownissue = KnownIssueMock(kwargs['title'], kwargs['test_name'])
-            return knownissue, False
+        def create_known_issues(self, test_names, environment):
+            known_issues['test_names'] = test_names
+            known_issues['environment'] = environment
 
         tasks = defaultdict(list)
 
-        def enqueue_testcases(self, testcases, testrun, suite):
+        def enqueue_testcases(self, testcases, testrun, suite_slug):
             for testcase in testcases:
-                tasks[suite['slug']].append(testcase)
+                tasks[suite_slug].append(testcase)
+            return 1, suite_slug
 
         xmlbuf = StringIO(XML_RESULTS)
-        with patch("squad.core.models.SuiteMetadata.objects.get_or_create", goc_mock), \
-                patch("squad.core.models.Suite.objects.get_or_create", goc_mock), \
-                patch("squad.core.models.KnownIssue.objects.get_or_create", goc_knownissues), \
+        with patch("tradefed.SuiteCache") as SuiteCache, \
+                patch("tradefed.create_ingestion_context"), \
+                patch("tradefed.create_progress"), \
+                patch("tradefed.create_lane"), \
+                patch("tradefed.Tradefed._create_known_issues", create_known_issues), \
                 patch("tradefed.celery_chord", chord_mock_func), \
                 patch("tradefed.tasks.update_build_status.s", update_s), \
                 patch("tradefed.Tradefed._enqueue_testcases_chunk", enqueue_testcases):
             self.plugin._extract_cts_results(xmlbuf, testrun, 'cts')
 
-        self.assertEqual(knownissue.title, 'Tradefed/cts/arm64-v8a.module_bar/TestCaseFoo.ztestSetAndGetBrightnessConfiguration')
-        self.assertEqual(knownissue.test_name, 'cts/arm64-v8a.module_bar/TestCaseFoo.ztestSetAndGetBrightnessConfiguration')
-        self.assertEqual(len(knownissue.environments), 1)
-        self.assertTrue(knownissue.saved)
+        SuiteCache.assert_called_with("MyProject", 'cts')
+        suites = SuiteCache.return_value
+        suites.add.assert_has_calls([call('cts/arm64-v8a.module_foo'), call('cts/arm64-v8a.module_bar')])
+        suites.flush.assert_called_once()
+        self.assertEqual(known_issues['test_names'], ['cts/arm64-v8a.module_bar/TestCaseFoo.ztestSetAndGetBrightnessConfiguration'])
+        self.assertEqual(known_issues['environment'], testrun.environment)
         self.assertEqual(tasks['cts/arm64-v8a.module_foo'], [
             {
                 'name': 'TestCaseBar',
@@ -1198,6 +1658,202 @@ class TradefedLogsPluginTest(unittest.TestCase):
                   at java.lang.Thread.run(Thread.java:1012)\n"""
         })
 
+    @patch("tradefed.create_progress", Mock(return_value=6))
+    @patch("tradefed.create_ingestion_context", Mock(return_value=7))
+    @patch("tradefed.create_lane", Mock())
+    @patch("tradefed.Tradefed._create_known_issues")
+    @patch("tradefed.celery_chord")
+    @patch("tradefed.create_testcase_tests_from_range")
+    @patch("tradefed.SuiteCache")
+    def test_extract_results_by_offset(self, mock_suite_cache, mock_task, mock_chord, mock_create_known_issues):
+        testrun = Mock(id=1, pk=1)
+        testrun.build.project = "MyProject"
+        attachment = Mock(id=5)
+        xml = XML_RESULTS.encode()
+
+        self.plugin._extract_cts_results_by_offset(BytesIO(xml), attachment, testrun, 'cts')
+
+        suites = mock_suite_cache.return_value
+        suites.add.assert_has_calls([call('cts/arm64-v8a.module_foo'), call('cts/arm64-v8a.module_bar')])
+        suites.flush.assert_called_once()
+        mock_create_known_issues.assert_called_once_with(['cts/arm64-v8a.module_bar/TestCaseFoo.ztestSetAndGetBrightnessConfiguration'], testrun.environment)
+        mock_chord.assert_called_once()
+
+        ranges = [c.args for c in mock_task.s.call_args_list]
+        self.assertEqual(['cts/arm64-v8a.module_foo', 'cts/arm64-v8a.module_bar'], [r[3] for r in ranges])
+        self.assertEqual({5}, {r[0] for r in ranges})
+        self.assertEqual({7}, {r[6] for r in ranges})
+
+        _, start, end, _, _, _, _ = ranges[0]
+        tests = parse_tests_range(xml[start:end])
+        self.assertEqual(5, len(tests))
+        self.assertEqual(('TestCaseBar', 'test_bar1', 'pass', ''), tests[0])
+        self.assertEqual(('TestCaseBar', 'test_bar4', 'fail'), tests[3][:3])
+        self.assertIn('Assert.java:88', tests[3][3])
+
+        _, start, end, _, _, _, _ = ranges[1]
+        tests = parse_tests_range(xml[start:end])
+        self.assertEqual(['test_bar1', 'test_bar2', 'test_bar3', 'test_bar4', 'xfirst_subname/second_subname.third_subname/test_bar5_64bit', 'ztestSetAndGetBrightnessConfiguration'], [t[1] for t in tests])
+
+    @patch("tradefed.create_progress", Mock(return_value=6))
+    @patch("tradefed.create_ingestion_context", Mock(return_value=7))
+    @patch("tradefed.create_lane", Mock())
+    @patch("tradefed.create_testcase_tests_from_range")
+    @patch("tradefed.SuiteCache")
+    def test_extract_results_by_offset_split_testcases(self, mock_suite_cache, mock_task):
+        testcases = "".join(f'<TestCase name="TestCase{i}"><Test result="pass" name="test" /></TestCase>' for i in range(250))
+        xml = f'<Result><Module name="module_foo">{testcases}</Module></Result>'.encode()
+
+        with patch("tradefed.celery_chord"), patch("tradefed.Tradefed._create_known_issues"):
+            self.plugin._extract_cts_results_by_offset(BytesIO(xml), Mock(id=5), Mock(), 'cts', max_tests=100)
+
+        ranges = [c.args for c in mock_task.s.call_args_list]
+        self.assertEqual(3, len(ranges))
+        tests = [test for _, start, end, _, _, _, _ in ranges for test in parse_tests_range(xml[start:end])]
+        self.assertEqual([f"TestCase{i}" for i in range(250)], [t[0] for t in tests])
+
+        mock_task.s.reset_mock()
+        with patch("tradefed.celery_chord"), patch("tradefed.Tradefed._create_known_issues"):
+            self.plugin._extract_cts_results_by_offset(BytesIO(xml), Mock(id=5), Mock(), 'cts', max_bytes=len(xml) // 2)
+
+        ranges = [c.args for c in mock_task.s.call_args_list]
+        self.assertEqual(2, len(ranges))
+
+    @patch("tradefed.create_progress", Mock())
+    @patch("tradefed.create_ingestion_context", Mock())
+    @patch("tradefed.create_lane", Mock())
+    @patch("tradefed.create_testcase_tests", Mock())
+    @patch("tradefed.celery_chord", Mock())
+    @patch("tradefed.Tradefed._create_known_issues", Mock())
+    @patch("tradefed.Tradefed._enqueue_testcases_chunk")
+    @patch("tradefed.SuiteCache", Mock())
+    def test_extract_results_chunk_limits(self, mock_enqueue):
+        testcases = "".join(f'<TestCase name="TestCase{i}"><Test result="pass" name="test1" /><Test result="pass" name="test2" /></TestCase>' for i in range(100))
+        xml = f'<Result><Module name="module_foo">{testcases}</Module><Module name="module_bar">{testcases}</Module></Result>'
+        mock_enqueue.return_value = (1, 'cts/module_foo')
+
+        def chunk_sizes():
+            sizes = [sum(len(testcase['tests']) for testcase in c.args[0]) for c in mock_enqueue.call_args_list]
+            mock_enqueue.reset_mock()
+            return sizes
+
+        self.plugin._extract_cts_results(StringIO(xml), Mock(), 'cts')
+        self.assertEqual([200, 200], chunk_sizes())
+
+        self.plugin._extract_cts_results(StringIO(xml), Mock(), 'cts', max_tests=50)
+        self.assertEqual([50, 50, 50, 50, 50, 50, 50, 50], chunk_sizes())
+
+        # Chunks only end between TestCases
+        self.plugin._extract_cts_results(StringIO(xml), Mock(), 'cts', max_tests=15)
+        self.assertEqual([16] * 12 + [8] + [16] * 12 + [8], chunk_sizes())
+
+        self.plugin._extract_cts_results(StringIO(xml), Mock(), 'cts', max_bytes=len("TestCase10") + 4 * len("test1"))
+        self.assertEqual([4] * 50 + [4] * 50, chunk_sizes())
+
+        # Chunks are never empty, even with a 0 limit
+        self.plugin._extract_cts_results(StringIO(xml), Mock(), 'cts', max_tests=0)
+        self.assertEqual([2] * 200, chunk_sizes())
+
+    @patch("tradefed.tasks.create_tests")
+    @patch("tradefed.tasks.Attachment")
+    def test_create_testcase_tests_from_range(self, mock_attachment, mock_create_tests):
+        xml = XML_RESULTS.encode()
+        start = xml.index(b'<TestCase name="TestCaseBar"')
+        end = xml.index(b'</Module>')
+        mock_attachment.objects.get.return_value.storage.open.return_value.__enter__.return_value = BytesIO(xml)
+
+        self.assertEqual(mock_create_tests.return_value, create_testcase_tests_from_range(5, start, end, "cts/module_foo", 2, 3))
+        mock_attachment.objects.get.assert_called_with(pk=5)
+
+        tests, suite_slug, testrun_id, suite_id, context_id = mock_create_tests.call_args[0]
+        self.assertEqual(["test_bar1", "test_bar2", "test_bar3", "test_bar4", "first_subname/second_subname.third_subname/test_bar5_64bit"], [t[1] for t in tests])
+        self.assertEqual(("cts/module_foo", 2, 3), (suite_slug, testrun_id, suite_id))
+
+    @patch("tradefed.tasks.record_progress")
+    @patch("tradefed.tasks.get_ingestion_context")
+    @patch("tradefed.tasks.create_tests")
+    @patch("tradefed.tasks.Attachment")
+    def test_create_testcase_tests_from_range_failed(self, mock_attachment, mock_create_tests, mock_get_context, mock_record_progress):
+        class does_not_exist_mock(Exception):
+            pass
+
+        mock_attachment.DoesNotExist = does_not_exist_mock
+        mock_get_context.return_value = {"testrun_id": 2, "progress_id": 6}
+        mock_attachment.objects.get.return_value.storage.open.return_value.__enter__.return_value = BytesIO(b"<TestCase name=")
+
+        # Unreadable ranges still complete their chunk
+        self.assertIsNone(create_testcase_tests_from_range(5, 0, 15, "cts/module_foo", 2, 3, 42))
+        mock_create_tests.assert_not_called()
+        mock_get_context.assert_called_once_with(2, 42)
+        mock_record_progress.assert_called_once_with(2, 6, 0)
+
+        mock_record_progress.reset_mock()
+        mock_attachment.objects.get.side_effect = does_not_exist_mock()
+        self.assertIsNone(create_testcase_tests_from_range(5, 0, 15, "cts/module_foo", 2, 3, 42))
+        mock_record_progress.assert_called_once_with(2, 6, 0)
+
+    @patch("tradefed.KnownIssue")
+    def test_create_known_issues(self, mock_knownissue):
+        stored = {"cts/module_foo/TestCase.test_a": Mock(id=1, title="Tradefed/cts/module_foo/TestCase.test_a", test_name="cts/module_foo/TestCase.test_a")}
+
+        def filter_mock(test_name__in):
+            return [stored[name] for name in test_name__in if name in stored]
+
+        def bulk_create_mock(issues):
+            for issue in issues:
+                issue.id = len(stored) + 1
+                stored[issue.test_name] = issue
+
+        mock_knownissue.side_effect = lambda title, test_name: Mock(title=title, test_name=test_name)
+        mock_knownissue.objects.filter.side_effect = filter_mock
+        mock_knownissue.objects.bulk_create.side_effect = bulk_create_mock
+
+        environment = Mock(id=5)
+        self.plugin._create_known_issues(["cts/module_foo/TestCase.test_a", "cts/module_foo/TestCase.test_b"], environment)
+
+        created = mock_knownissue.objects.bulk_create.call_args[0][0]
+        self.assertEqual(["Tradefed/cts/module_foo/TestCase.test_b"], [issue.title for issue in created])
+
+        through = mock_knownissue.environments.through
+        self.assertEqual({1, 2}, {c.kwargs["knownissue_id"] for c in through.call_args_list})
+        self.assertEqual({5}, {c.kwargs["environment_id"] for c in through.call_args_list})
+        through.objects.bulk_create.assert_called_once()
+
+    @patch("tradefed.KnownIssue")
+    def test_create_known_issues_empty(self, mock_knownissue):
+        self.plugin._create_known_issues([], Mock())
+        mock_knownissue.objects.filter.assert_not_called()
+        mock_knownissue.environments.through.objects.bulk_create.assert_not_called()
+
+    @patch("tradefed.suites.SuiteMetadata")
+    @patch("tradefed.suites.Suite")
+    def test_suite_cache(self, mock_suite, mock_metadata):
+        existing = Mock(slug="cts/module_foo")
+        metadata = Mock(suite="cts/module_bar")
+        created = Mock(slug="cts/module_bar")
+        mock_suite.objects.filter.side_effect = [[existing], [created]]
+        mock_metadata.objects.filter.return_value = [metadata]
+
+        suites = SuiteCache("MyProject", "cts", flush_size=10)
+        mock_suite.objects.filter.assert_called_with(project="MyProject", slug__startswith="cts/")
+
+        suites.add("cts/module_foo")
+        suites.add("cts/module_bar")
+        suites.add("cts/module_bar")
+        self.assertEqual(existing, suites.get("cts/module_foo"))
+        mock_suite.objects.bulk_create.assert_not_called()
+
+        self.assertEqual(created, suites.get("cts/module_bar"))
+        mock_metadata.assert_called_once_with(kind="suite", suite="cts/module_bar", name="-")
+        self.assertEqual({"ignore_conflicts": True}, mock_metadata.objects.bulk_create.call_args[1])
+        mock_metadata.objects.filter.assert_called_once_with(kind="suite", suite__in=["cts/module_bar"], name="-")
+        mock_suite.objects.bulk_create.assert_called_once()
+        mock_suite.assert_called_once_with(project="MyProject", slug="cts/module_bar", metadata=metadata)
+
+        # Nothing else to create
+        suites.flush()
+        mock_suite.objects.bulk_create.assert_called_once()
+
     def test_extract_tarball_filename_from_url(self):
 
         # Make sure it returns None if no valid filenames are found
@@ -1312,3 +1968,689 @@ class TradefedLogsPluginTest(unittest.TestCase):
 
         update_build_status(None, None, None, None)
         mock_update_testjob_status.assert_not_called()
+
+    @patch("tradefed.tasks.RecordTestRunStatus")
+    @patch("tradefed.tasks.update_testjob_status.delay")
+    @patch("tradefed.tasks.transaction")
+    @patch("tradefed.tasks.get_suite_version")
+    @patch("tradefed.tasks.Suite")
+    @patch("tradefed.tasks.Status")
+    @patch("tradefed.tasks.TestRun")
+    def test_update_build_status_with_counters(self, mock_testrun, mock_status, mock_suite, mock_suite_version, mock_transaction, mock_update_testjob_status, mock_record_status):
+        testrun = mock_testrun.objects.get.return_value
+        testrun.status_recorded = True
+
+        testrun_status = Mock(suite_id=None, tests_pass=10, tests_fail=1, tests_xfail=0, tests_skip=0)
+        suite_status = Mock(suite_id=3, tests_pass=1, tests_fail=0, tests_xfail=0, tests_skip=0)
+        mock_status.objects.select_for_update.return_value.filter.return_value.filter.return_value = [testrun_status, suite_status]
+        mock_status.side_effect = lambda **kwargs: Mock(tests_pass=0, tests_fail=0, tests_xfail=0, tests_skip=0, **kwargs)
+        mock_suite.objects.in_bulk.return_value = {4: "suite 4"}
+
+        update_build_status([[[3, 5, 1, 1, 0], [4, 2, 0, 0, 1]], [[3, 1, 0, 0, 0]]], 1, 2, "Complete")
+
+        self.assertEqual((18, 2, 1, 1), (testrun_status.tests_pass, testrun_status.tests_fail, testrun_status.tests_xfail, testrun_status.tests_skip))
+        self.assertEqual((7, 1, 1, 0), (suite_status.tests_pass, suite_status.tests_fail, suite_status.tests_xfail, suite_status.tests_skip))
+        mock_suite.objects.in_bulk.assert_called_once_with([4])
+
+        created = mock_status.objects.bulk_create.call_args[0][0]
+        self.assertEqual(1, len(created))
+        self.assertEqual("suite 4", created[0].suite)
+        self.assertEqual((2, 0, 0, 1), (created[0].tests_pass, created[0].tests_fail, created[0].tests_xfail, created[0].tests_skip))
+
+        mock_status.objects.filter.assert_not_called()
+        mock_record_status.assert_not_called()
+        mock_update_testjob_status.assert_called_once_with(2, "Complete")
+
+    @patch("tradefed.tasks.transaction", MagicMock())
+    @patch("tradefed.tasks.get_suite_version", Mock())
+    @patch("tradefed.tasks.Suite", Mock())
+    @patch("tradefed.tasks.Status")
+    @patch("tradefed.tasks.TestRun")
+    def test_record_status_counters_once(self, mock_testrun, mock_status):
+        locked = mock_testrun.objects.select_for_update.return_value.get.return_value
+        locked.metadata = {}
+        testrun = Mock(pk=1, id=1, status_recorded=True, metadata={})
+
+        self.assertTrue(record_status_counters(testrun, [[3, 5, 1, 0, 0]], 42))
+        self.assertEqual({"tradefed_status_counters": [42]}, locked.metadata)
+        locked.save.assert_called_once_with(update_fields=['metadata_file'])
+        mock_status.objects.bulk_update.assert_called_once()
+
+        # A redelivered callback doesn't count the same tests again
+        mock_status.reset_mock()
+        self.assertTrue(record_status_counters(testrun, [[3, 5, 1, 0, 0]], 42))
+        mock_status.objects.select_for_update.assert_not_called()
+        mock_status.objects.bulk_update.assert_not_called()
+
+    @patch("tradefed.tasks.RecordTestRunStatus")
+    @patch("tradefed.tasks.update_testjob_status.delay")
+    @patch("tradefed.tasks.Status")
+    @patch("tradefed.tasks.TestRun")
+    def test_update_build_status_missing_counters(self, mock_testrun, mock_status, mock_update_testjob_status, mock_record_status):
+        testrun = mock_testrun.objects.get.return_value
+        testrun.status_recorded = True
+
+        update_build_status([[[3, 5, 1, 1, 0], None]], 1, 2, "Complete")
+
+        mock_status.objects.filter.return_value.all.return_value.delete.assert_called_once()
+        mock_record_status.return_value.assert_called_once_with(testrun)
+        self.assertFalse(testrun.status_recorded)
+        mock_update_testjob_status.assert_called_once_with(2, "Complete")
+
+    @patch("tradefed.tasks.finish_progress")
+    @patch("tradefed.tasks.get_ingestion_context")
+    @patch("tradefed.tasks.delete_ingestion_context")
+    @patch("tradefed.tasks.RecordTestRunStatus")
+    @patch("tradefed.tasks.update_testjob_status.delay")
+    @patch("tradefed.tasks.Status")
+    @patch("tradefed.tasks.TestRun")
+    def test_update_build_status_finishes_progress(self, mock_testrun, mock_status, mock_update_testjob_status, mock_record_status, mock_delete_context, mock_get_context, mock_finish_progress):
+        testrun = mock_testrun.objects.get.return_value
+        mock_get_context.return_value = {"testrun_id": 1, "progress_id": 6}
+
+        update_build_status([[None]], 1, 2, "Complete", 42)
+
+        mock_delete_context.assert_called_once_with(1, 42)
+        mock_finish_progress.assert_called_once_with(testrun, 6)
+        testrun.save.assert_any_call(update_fields=['metadata_file'])
+
+    def test_progress_metadata(self):
+        progress = {"chunks_total": 10, "chunks_completed": 0, "tests_created": 0, "started_at": 100.0}
+        self.assertIsNone(progress_metadata(progress, 110.0)["eta_seconds"])
+
+        progress.update(chunks_completed=4, tests_created=4000)
+        metadata = progress_metadata(progress, 120.0)
+        self.assertEqual((10, 4, 4000, 30), (metadata["chunks_total"], metadata["chunks_completed"], metadata["tests_created"], metadata["eta_seconds"]))
+        self.assertEqual("1970-01-01T00:02:00+00:00", metadata["updated_at"])
+
+        progress.update(chunks_completed=10)
+        self.assertEqual(0, progress_metadata(progress, 130.0)["eta_seconds"])
+
+    @patch("tradefed.progress.time.time", Mock(return_value=105.0))
+    @patch("tradefed.progress.transaction", MagicMock())
+    @patch("tradefed.progress.TestRun")
+    @patch("tradefed.progress.PluginScratch")
+    def test_record_progress(self, mock_scratch, mock_testrun):
+        scratch = mock_scratch.objects.select_for_update.return_value.get.return_value
+        scratch.storage = json.dumps({"chunks_total": 3, "chunks_completed": 0, "tests_created": 0, "started_at": 100.0, "published_at": 100.0})
+
+        record_progress(1, 6, 500)
+
+        progress = json.loads(scratch.storage)
+        self.assertEqual((1, 500, 100.0), (progress["chunks_completed"], progress["tests_created"], progress["published_at"]))
+        scratch.save.assert_called_once_with(update_fields=['storage'])
+        mock_testrun.objects.select_for_update.assert_not_called()
+
+        with patch("tradefed.progress.time.time", Mock(return_value=110.0)):
+            record_progress(1, 6, 500)
+
+        progress = json.loads(scratch.storage)
+        self.assertEqual((2, 1000, 110.0), (progress["chunks_completed"], progress["tests_created"], progress["published_at"]))
+        testrun = mock_testrun.objects.select_for_update.return_value.get.return_value
+        mock_testrun.objects.select_for_update.return_value.get.assert_called_once_with(pk=1)
+        testrun.metadata.__setitem__.assert_called_once()
+        self.assertEqual(5, testrun.metadata.__setitem__.call_args[0][1]["eta_seconds"])
+        testrun.save.assert_called_once_with(update_fields=['metadata_file'])
+
+        # The last chunk always publishes
+        record_progress(1, 6, 200)
+        self.assertEqual(2, testrun.save.call_count)
+        self.assertEqual((3, 1200, 0), tuple(testrun.metadata.__setitem__.call_args[0][1][k] for k in ("chunks_completed", "tests_created", "eta_seconds")))
+
+    @patch("tradefed.progress.PluginScratch")
+    def test_finish_progress(self, mock_scratch):
+        scratch = mock_scratch.objects.get.return_value
+        scratch.storage = json.dumps({"chunks_total": 3, "chunks_completed": 2, "tests_created": 800, "started_at": 100.0, "published_at": 100.0})
+        testrun = Mock(metadata={})
+
+        finish_progress(testrun, 6)
+
+        mock_scratch.objects.get.assert_called_once_with(pk=6)
+        self.assertEqual((3, 2, 800, 0), tuple(testrun.metadata[PROGRESS_METADATA_KEY][k] for k in ("chunks_total", "chunks_completed", "tests_created", "eta_seconds")))
+        scratch.delete.assert_called_once()
+        testrun.save.assert_not_called()
+
+    @patch("tradefed.tasks.record_progress")
+    @patch("tradefed.tasks.get_or_create_test_metadata")
+    @patch("tradefed.tasks.Test")
+    @patch("tradefed.tasks.get_ingestion_context")
+    def test_create_tests_records_progress(self, mock_get_context, mock_test, mock_get_metadata, mock_record_progress):
+        mock_get_context.return_value = {"testrun_id": 2, "build_id": 4, "environment_id": 5, "known_issues": {}, "progress_id": 6}
+        mock_get_metadata.return_value = {"TestCaseFoo.test_bar1": Mock(), "TestCaseFoo.test_bar2": Mock()}
+        mock_test.side_effect = lambda **kwargs: Mock(**kwargs)
+        mock_test.objects.bulk_create.side_effect = lambda tests: tests
+
+        scratch_tests = [("TestCaseFoo", "test_bar1", "pass", ""), ("TestCaseFoo", "test_bar2", "fail", "")]
+        self.assertEqual([3, 1, 1, 0, 0], create_tests(scratch_tests, "cts/module_foo", 2, 3, 42))
+        mock_record_progress.assert_called_once_with(2, 6, 2)
+
+        # Failed chunks are completed too
+        mock_record_progress.reset_mock()
+        mock_test.objects.bulk_create.side_effect = Exception("boom")
+        self.assertIsNone(create_tests(scratch_tests, "cts/module_foo", 2, 3, 42))
+        mock_record_progress.assert_called_once_with(2, 6, 0)
+
+    @patch("tradefed.tasks.record_status_counters")
+    @patch("tradefed.tasks.get_ingestion_context")
+    @patch("tradefed.tasks.delete_ingestion_context", Mock())
+    @patch("tradefed.tasks.RecordTestRunStatus")
+    @patch("tradefed.tasks.update_testjob_status.delay", Mock())
+    @patch("tradefed.tasks.Status")
+    @patch("tradefed.tasks.TestRun")
+    def test_update_build_status_failures_only_recompute(self, mock_testrun, mock_status, mock_record_status, mock_get_context, mock_record_counters):
+        testrun = mock_testrun.objects.get.return_value
+        testrun.metadata = {}
+        mock_get_context.return_value = {"testrun_id": 1, "failures_only": True}
+        mock_record_counters.return_value = False
+
+        update_build_status([[[3, 5, 1, 1, 0], None], [[4, 2, 0, 0, 1], [3, 1, 0, 0, 0]]], 1, 2, "Complete", 42)
+
+        # Passes of the chunks that completed are kept before the status is recomputed
+        self.assertEqual({"tradefed_passes": [[3, 6], [4, 2]]}, testrun.metadata)
+        testrun.save.assert_called_once_with(update_fields=['metadata_file'])
+        mock_record_status.return_value.assert_called_once_with(testrun)
+        mock_record_counters.assert_called_once()
+
+    @patch("tradefed.tasks.transaction", MagicMock())
+    @patch("tradefed.tasks.get_suite_version", Mock())
+    @patch("tradefed.tasks.Suite")
+    @patch("tradefed.tasks.Test")
+    @patch("tradefed.tasks.Status")
+    def test_apply_passes(self, mock_status, mock_test, mock_suite):
+        testrun = Mock(status_recorded=True, metadata={"tradefed_passes": [[3, 6], [4, 2]]})
+        mock_test.objects.filter.return_value.values.return_value.annotate.return_value.order_by.return_value = [
+            {"suite_id": 4, "pass_count": 1},
+            {"suite_id": 9, "pass_count": 3},
+        ]
+        statuses = {suite_id: Mock(suite_id=suite_id, tests_pass=0) for suite_id in (None, 4)}
+        mock_status.objects.select_for_update.return_value.filter.return_value.filter.return_value = statuses.values()
+        mock_suite.objects.in_bulk.return_value = {3: Mock()}
+        mock_status.side_effect = lambda **kwargs: Mock(tests_pass=0, **kwargs)
+
+        # Recomputing the status saves the testrun, which gets its passes back
+        reapply_passes(TestRun, testrun)
+        self.assertEqual(12, statuses[None].tests_pass)
+        self.assertEqual(3, statuses[4].tests_pass)
+        mock_suite.objects.in_bulk.assert_called_once_with([3])
+        new_statuses = mock_status.objects.bulk_create.call_args[0][0]
+        self.assertEqual([6], [status.tests_pass for status in new_statuses])
+
+        # Applying them again doesn't change the counters
+        reapply_passes(TestRun, testrun)
+        self.assertEqual(12, statuses[None].tests_pass)
+        self.assertEqual(3, statuses[4].tests_pass)
+
+        # Saving only some fields, or a testrun without passes, does nothing
+        mock_status.reset_mock()
+        reapply_passes(TestRun, testrun, update_fields=['metadata_file'])
+        reapply_passes(TestRun, Mock(status_recorded=True, metadata={}))
+        mock_status.objects.select_for_update.assert_not_called()
+
+    @patch("tradefed.tasks.SuiteMetadata")
+    def test_get_or_create_test_metadata(self, mock_metadata):
+        stored = {"test_a": Mock()}
+        stored["test_a"].name = "test_a"
+
+        def filter_mock(suite, kind, name__in):
+            self.assertEqual(("cts/module_foo", "test"), (suite, kind))
+            return [stored[name] for name in name__in if name in stored]
+
+        def bulk_create_mock(objs, ignore_conflicts):
+            self.assertTrue(ignore_conflicts)
+            for obj in objs:
+                stored[obj.name] = obj
+
+        def metadata_mock(suite, kind, name):
+            metadata = Mock(suite=suite, kind=kind)
+            metadata.name = name
+            return metadata
+
+        mock_metadata.side_effect = metadata_mock
+        mock_metadata.objects.filter.side_effect = filter_mock
+        mock_metadata.objects.bulk_create.side_effect = bulk_create_mock
+
+        metadata = get_or_create_test_metadata("cts/module_foo", {"test_a", "test_b", "test_c"})
+        self.assertEqual({"test_a", "test_b", "test_c"}, set(metadata.keys()))
+        self.assertIs(stored["test_a"], metadata["test_a"])
+        self.assertEqual("test_b", metadata["test_b"].name)
+        self.assertEqual(2, mock_metadata.objects.filter.call_count)
+        self.assertEqual(1, mock_metadata.objects.bulk_create.call_count)
+        self.assertEqual({"test_b", "test_c"}, {m.name for m in mock_metadata.objects.bulk_create.call_args[0][0]})
+
+    @patch("tradefed.tasks.get_or_create_test_metadata")
+    @patch("tradefed.tasks.Test")
+    @patch("tradefed.context.KnownIssue")
+    @patch("tradefed.context.TestRun")
+    @patch("tradefed.tasks.PluginScratch")
+    def test_create_testcase_tests_known_issues(self, mock_scratch, mock_testrun, mock_knownissue, mock_test, mock_get_metadata):
+        mock_scratch.objects.get.return_value.storage = json.dumps([{
+            "name": "TestCaseFoo",
+            "tests": [
+                {"result": "pass", "name": "test_bar1"},
+                {"result": "ASSUMPTION_FAILURE", "name": "test_bar2"},
+            ],
+        }])
+
+        issue = Mock(id=10, test_name="cts/module_foo/TestCaseFoo.test_bar2")
+        mock_knownissue.active_by_environment.return_value = [issue]
+        mock_testrun.objects.get.return_value.build.project.get_setting.side_effect = lambda key, default=None: default
+        mock_get_metadata.return_value = {"TestCaseFoo.test_bar1": Mock(), "TestCaseFoo.test_bar2": Mock()}
+        mock_test.side_effect = lambda **kwargs: Mock(**kwargs)
+        mock_test.objects.bulk_create.side_effect = lambda tests: [Mock(id=i) for i in range(len(tests))]
+
+        self.assertEqual([3, 1, 0, 1, 0], create_testcase_tests(1, "cts/module_foo", 2, 3))
+
+        tests = mock_test.objects.bulk_create.call_args[0][0]
+        self.assertEqual([True, False], [t.result for t in tests])
+        self.assertEqual([False, True], [t.has_known_issues for t in tests])
+
+        through = mock_test.known_issues.through
+        through.assert_called_once_with(test_id=1, knownissue_id=10)
+        through.objects.bulk_create.assert_called_once_with([through.return_value], ignore_conflicts=True)
+
+    @patch("tradefed.tasks.get_or_create_test_metadata")
+    @patch("tradefed.tasks.Test")
+    @patch("tradefed.context.TestRun")
+    @patch("tradefed.context.PluginScratch")
+    @patch("tradefed.tasks.PluginScratch")
+    def test_create_testcase_tests_with_context(self, mock_scratch, mock_context_scratch, mock_testrun, mock_test, mock_get_metadata):
+        mock_scratch.objects.get.return_value.storage = encode_testcases([{
+            "name": "TestCaseFoo",
+            "tests": [{"result": "fail", "name": "test_bar1"}],
+        }])
+        context = {
+            "testrun_id": 2,
+            "build_id": 4,
+            "environment_id": 5,
+            "known_issues": {"cts/module_foo/TestCaseFoo.test_bar1": [10, 11]},
+        }
+        mock_context_scratch.objects.get.return_value.storage = json.dumps(context)
+        mock_get_metadata.return_value = {"TestCaseFoo.test_bar1": Mock()}
+        mock_test.side_effect = lambda **kwargs: Mock(**kwargs)
+        mock_test.objects.bulk_create.side_effect = lambda tests: [Mock(id=i) for i in range(len(tests))]
+
+        self.assertEqual([3, 0, 0, 1, 0], create_testcase_tests(1, "cts/module_foo", 2, 3, 42))
+        self.assertEqual([3, 0, 0, 1, 0], create_testcase_tests(1, "cts/module_foo", 2, 3, 42))
+
+        # The context is read once per worker, and the testrun not at all
+        mock_context_scratch.objects.get.assert_called_once_with(pk=42)
+        mock_testrun.objects.get.assert_not_called()
+
+        test = mock_test.objects.bulk_create.call_args[0][0][0]
+        self.assertEqual((2, 4, 5), (test.test_run_id, test.build_id, test.environment_id))
+        self.assertEqual({10, 11}, {c.kwargs["knownissue_id"] for c in mock_test.known_issues.through.call_args_list})
+
+        with patch("tradefed.tasks.TestRun") as mock_tasks_testrun:
+            mock_tasks_testrun.DoesNotExist = Exception
+            mock_tasks_testrun.objects.get.side_effect = Exception
+            update_build_status([], 2, 1, "Complete", 42)
+        mock_context_scratch.objects.filter.assert_called_once_with(pk=42)
+
+        # Once deleted, the context is no longer remembered
+        create_testcase_tests(1, "cts/module_foo", 2, 3, 42)
+        self.assertEqual(2, mock_context_scratch.objects.get.call_count)
+
+    @patch("tradefed.update_build_status")
+    @patch("tradefed.ingest_lane")
+    @patch("tradefed.create_lane")
+    @patch("tradefed.celery_chord")
+    def test_run_chunks(self, mock_chord, mock_create_lane, mock_ingest_lane, mock_update_build_status):
+        mock_create_lane.side_effect = lambda build, lane: lane
+        mock_ingest_lane.s.side_effect = lambda lane_id: lane_id
+        self.plugin.extra_args = {"job_id": 1, "job_status": "Complete"}
+
+        testrun = Mock(pk=2)
+        self.plugin._run_chunks(["a", "b", "c", "d", "e"], testrun, 7, 2)
+        mock_create_lane.assert_any_call(testrun.build, ["a", "c", "e"])
+        mock_chord.assert_called_once_with([["a", "c", "e"], ["b", "d"]])
+        mock_update_build_status.s.assert_called_once_with(2, 1, "Complete", 7)
+
+        mock_chord.reset_mock()
+        self.plugin._run_chunks(["a", "b"], Mock(pk=2), 7, 16)
+        mock_chord.assert_called_once_with([["a"], ["b"]])
+
+    def mock_lanes(self, mock_plugin_scratch):
+        lanes = {}
+
+        def create(build, storage):
+            lanes[len(lanes) + 1] = storage
+            return Mock(id=len(lanes))
+
+        def get(pk):
+            return Mock(storage=lanes[pk])
+
+        def filter(pk):
+            queryset = Mock()
+            queryset.update.side_effect = lambda storage: lanes.__setitem__(pk, lanes[pk] + storage)
+            queryset.delete.side_effect = lambda: lanes.pop(pk)
+            return queryset
+
+        mock_plugin_scratch.objects.create.side_effect = create
+        mock_plugin_scratch.objects.get.side_effect = get
+        mock_plugin_scratch.objects.filter.side_effect = filter
+        return lanes
+
+    @patch("tradefed.tasks.Value", lambda value: value)
+    @patch("tradefed.tasks.F", lambda field: "")
+    @patch("tradefed.tasks.Concat", lambda *values: "".join(values))
+    @patch("tradefed.tasks.PluginScratch")
+    @patch("tradefed.tasks.signature")
+    def test_ingest_lane(self, mock_signature, mock_plugin_scratch):
+        lanes = self.mock_lanes(mock_plugin_scratch)
+        mock_signature.side_effect = lambda chunk, app: (lambda: [chunk.upper(), 1])
+
+        lane_id = create_lane(Mock(), ["a", "b", "c"])
+        self.assertEqual('["a", "b", "c"]', lanes[lane_id])
+
+        # Every task only gets the lane id and the index of its chunk
+        with patch.object(ingest_lane, "replace", wraps=ingest_lane.replace) as mock_replace:
+            self.assertEqual([["A", 1], ["B", 1], ["C", 1]], ingest_lane.apply(args=(lane_id,)).get())
+        self.assertEqual([(lane_id, 1), (lane_id, 2)], [call.args[0].args for call in mock_replace.mock_calls])
+        self.assertEqual({}, lanes)
+
+    @patch("tradefed.tasks.Value", lambda value: value)
+    @patch("tradefed.tasks.F", lambda field: "")
+    @patch("tradefed.tasks.Concat", lambda *values: "".join(values))
+    @patch("tradefed.tasks.PluginScratch")
+    @patch("tradefed.tasks.signature")
+    def test_ingest_lane_failed_chunk(self, mock_signature, mock_plugin_scratch):
+        lanes = self.mock_lanes(mock_plugin_scratch)
+
+        def run(chunk):
+            if chunk == "b":
+                raise Exception("could not connect to server")
+            return chunk.upper()
+
+        mock_signature.side_effect = lambda chunk, app: (lambda: run(chunk))
+        lane_id = create_lane(Mock(), ["a", "b", "c"])
+        self.assertEqual(["A", None, "C"], ingest_lane.apply(args=(lane_id,)).get())
+        self.assertEqual({}, lanes)
+
+    @patch("tradefed.tasks.Value", lambda value: value)
+    @patch("tradefed.tasks.F", lambda field: "")
+    @patch("tradefed.tasks.Concat", lambda *values: "".join(values))
+    @patch("tradefed.tasks.PluginScratch")
+    @patch("tradefed.tasks.signature")
+    def test_ingest_lane_redelivered(self, mock_signature, mock_plugin_scratch):
+        lanes = self.mock_lanes(mock_plugin_scratch)
+        mock_signature.side_effect = lambda chunk, app: (lambda: chunk.upper())
+
+        # The result of the first chunk was stored before the task was redelivered
+        lane_id = create_lane(Mock(), ["a", "b"])
+        lanes[lane_id] += '\n"A"'
+        self.assertEqual(["A", "B"], ingest_lane.apply(args=(lane_id,)).get())
+        mock_signature.assert_called_once_with("b", app=ANY)
+
+    @patch("tradefed.tasks.PluginScratch")
+    @patch("tradefed.tasks.signature")
+    @patch("tradefed.tasks.connection")
+    def test_ingest_lane_no_slot(self, mock_connection, mock_signature, mock_plugin_scratch):
+        lanes = self.mock_lanes(mock_plugin_scratch)
+        mock_connection.vendor = "postgresql"
+        mock_connection.cursor.return_value.__enter__.return_value.fetchone.return_value = (False,)
+
+        lane_id = create_lane(Mock(), ["a"])
+        with override_settings(PLUGINS_TRADEFED_GLOBAL_MAX_CHUNKS_IN_FLIGHT=4):
+            with self.assertRaises(Retry):
+                ingest_lane(lane_id)
+        mock_signature.assert_not_called()
+        self.assertEqual('["a"]', lanes[lane_id])
+
+    @patch("tradefed.tasks.signature")
+    def test_ingest_chunks(self, mock_signature):
+        mock_signature.side_effect = lambda chunk, app: (lambda: chunk.upper())
+        self.assertEqual(["A", "B", "C"], ingest_chunks.apply(args=(["a", "b", "c"],)).get())
+
+    @patch("tradefed.tasks.signature")
+    def test_ingest_chunks_failed_chunk(self, mock_signature):
+        def run(chunk):
+            if chunk == "b":
+                raise Exception("could not connect to server")
+            return chunk.upper()
+
+        mock_signature.side_effect = lambda chunk, app: (lambda: run(chunk))
+        self.assertEqual(["A", None, "C"], ingest_chunks.apply(args=(["a", "b", "c"],)).get())
+
+    @patch("tradefed.tasks.signature")
+    @patch("tradefed.tasks.connection")
+    def test_ingest_chunks_no_slot(self, mock_connection, mock_signature):
+        mock_connection.vendor = "postgresql"
+        mock_connection.cursor.return_value.__enter__.return_value.fetchone.return_value = (False,)
+
+        with override_settings(PLUGINS_TRADEFED_GLOBAL_MAX_CHUNKS_IN_FLIGHT=4):
+            with self.assertRaises(Retry):
+                ingest_chunks(["a"])
+        mock_signature.assert_not_called()
+
+    @patch("tradefed.tasks.connection")
+    def test_ingestion_slot(self, mock_connection):
+        cursor = mock_connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.side_effect = [(False,), (False,), (True,)]
+
+        # No limit, no locks
+        mock_connection.vendor = "postgresql"
+        with ingestion_slot() as acquired:
+            self.assertTrue(acquired)
+        cursor.execute.assert_not_called()
+
+        with override_settings(PLUGINS_TRADEFED_GLOBAL_MAX_CHUNKS_IN_FLIGHT=4):
+            with ingestion_slot() as acquired:
+                self.assertTrue(acquired)
+                # Slots are tried one at a time until one is free
+                self.assertEqual(3, cursor.execute.call_count)
+                self.assertIn("pg_try_advisory_lock", cursor.execute.call_args[0][0])
+                self.assertEqual(2, cursor.execute.call_args[0][1][1])
+
+            self.assertIn("pg_advisory_unlock", cursor.execute.call_args[0][0])
+            self.assertEqual(2, cursor.execute.call_args[0][1][1])
+
+            # Other databases don't have advisory locks
+            cursor.execute.reset_mock()
+            mock_connection.vendor = "sqlite"
+            with ingestion_slot() as acquired:
+                self.assertTrue(acquired)
+            cursor.execute.assert_not_called()
+
+    @patch("tradefed.loader.transaction", MagicMock())
+    @patch("tradefed.loader.connection")
+    def test_copy_tests(self, mock_connection):
+        mock_connection.vendor = "postgresql"
+        mock_connection.ops.quote_name.side_effect = lambda name: f'"{name}"'
+        cursor = mock_connection.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [(101,), (102,)]
+
+        copied = {}
+
+        def copy_expert(sql, rows):
+            copied["sql"] = sql
+            copied["rows"] = rows.read()
+
+        cursor.copy_expert.side_effect = copy_expert
+
+        tests = [
+            Test(test_run_id=1, build_id=2, environment_id=3, suite_id=4, metadata_id=5, result=True, log="", has_known_issues=False),
+            Test(test_run_id=1, build_id=2, environment_id=3, suite_id=4, metadata_id=6, result=False, log="line 1\n\tat \\foo", has_known_issues=True),
+        ]
+
+        self.assertEqual(tests, copy_tests(tests))
+        self.assertEqual([101, 102], [test.id for test in tests])
+        self.assertEqual(2, cursor.execute.call_args[0][1][2])
+
+        self.assertTrue(copied["sql"].startswith('COPY "core_test" ("id", "build_id", "environment_id", "test_run_id", "suite_id", "metadata_id", "result", "log", "has_known_issues")'))
+        self.assertEqual([
+            "101\t2\t3\t1\t4\t5\tt\t\tf",
+            "102\t2\t3\t1\t4\t6\tf\tline 1\\n\\tat \\\\foo\tt",
+        ], copied["rows"].splitlines())
+
+    @patch("tradefed.loader.Test")
+    @patch("tradefed.loader.connection")
+    def test_copy_tests_fallback(self, mock_connection, mock_test):
+        mock_connection.vendor = "sqlite"
+        tests = [Mock()]
+        self.assertEqual(mock_test.objects.bulk_create.return_value, copy_tests(tests))
+        mock_test.objects.bulk_create.assert_called_once_with(tests)
+        mock_connection.cursor.assert_not_called()
+
+    @patch("tradefed.tasks.copy_tests")
+    @patch("tradefed.tasks.get_or_create_test_metadata")
+    @patch("tradefed.tasks.Test")
+    @patch("tradefed.tasks.get_ingestion_context")
+    def test_create_tests_with_copy_loader(self, mock_get_context, mock_test, mock_get_metadata, mock_copy_tests):
+        mock_get_context.return_value = {"testrun_id": 2, "build_id": 4, "environment_id": 5, "known_issues": {}, "loader": "copy"}
+        mock_get_metadata.return_value = {"TestCaseFoo.test_bar1": Mock()}
+        mock_copy_tests.side_effect = lambda tests: tests
+
+        self.assertEqual([3, 1, 0, 0, 0], create_tests([("TestCaseFoo", "test_bar1", "pass", "")], "cts/module_foo", 2, 3, 42))
+        mock_copy_tests.assert_called_once()
+        mock_test.objects.bulk_create.assert_not_called()
+
+    @patch("tradefed.tasks.get_or_create_test_metadata")
+    @patch("tradefed.tasks.Test")
+    @patch("tradefed.tasks.get_ingestion_context")
+    def test_create_tests_failures_only(self, mock_get_context, mock_test, mock_get_metadata):
+        mock_get_context.return_value = {"testrun_id": 2, "build_id": 4, "environment_id": 5, "known_issues": {}, "failures_only": True}
+        mock_get_metadata.return_value = {"TestCaseFoo.test_bar2": Mock(), "TestCaseFoo.test_bar3": Mock()}
+        mock_test.side_effect = lambda **kwargs: Mock(**kwargs)
+        mock_test.objects.bulk_create.side_effect = lambda tests: tests
+
+        scratch_tests = [
+            ("TestCaseFoo", "test_bar1", "pass", ""),
+            ("TestCaseFoo", "test_bar2", "fail", "trace"),
+            ("TestCaseFoo", "test_bar3", "IGNORED", ""),
+            ("TestCaseFoo", "test_bar4", "pass", ""),
+        ]
+        self.assertEqual([3, 2, 1, 0, 1], create_tests(scratch_tests, "cts/module_foo", 2, 3, 42))
+
+        tests = mock_test.objects.bulk_create.call_args[0][0]
+        self.assertEqual([False, None], [t.result for t in tests])
+        self.assertEqual({"TestCaseFoo.test_bar2", "TestCaseFoo.test_bar3"}, mock_get_metadata.call_args[0][1])
+
+    @patch("tradefed.create_progress", Mock(return_value=6))
+    @patch("tradefed.create_testcase_tests", Mock())
+    @patch("tradefed.Tradefed._run_chunks", Mock())
+    @patch("tradefed.Tradefed._create_known_issues", Mock())
+    @patch("tradefed.Tradefed._enqueue_testcases_chunk", Mock(return_value=(1, "cts/arm64-v8a.module_foo")))
+    @patch("tradefed.SuiteCache", Mock())
+    @patch("tradefed.create_ingestion_context")
+    @patch("tradefed.Tradefed._create_testrun_attachment")
+    def test_extract_results_failures_only(self, mock_create_attachment, mock_create_context):
+        attached = {}
+
+        def create_attachment(testrun, name, extracted_file, mimetype):
+            extracted_file.contents.seek(0)
+            attached[name] = (gzip.decompress(extracted_file.contents.read()).decode(), extracted_file.length, mimetype)
+
+        mock_create_attachment.side_effect = create_attachment
+        expected = "\n".join([
+            "cts/arm64-v8a.module_foo/TestCaseBar.test_bar1",
+            "cts/arm64-v8a.module_foo/TestCaseBar.test_bar2",
+            "cts/arm64-v8a.module_foo/TestCaseBar.test_bar3",
+            "cts/arm64-v8a.module_bar/TestCaseFoo.test_bar1",
+            "cts/arm64-v8a.module_bar/TestCaseFoo.test_bar2",
+            "cts/arm64-v8a.module_bar/TestCaseFoo.test_bar3",
+        ]) + "\n"
+
+        testrun = Mock()
+        self.plugin._extract_cts_results(StringIO(XML_RESULTS), testrun, 'cts', failures_only=True)
+        mock_create_context.assert_called_once_with(testrun, 6, True)
+        contents, length, mimetype = attached.pop("passing_tests.txt.gz")
+        self.assertEqual(expected, contents)
+        self.assertEqual("application/gzip", mimetype)
+        self.assertGreater(length, 0)
+
+        with patch("tradefed.create_testcase_tests_from_range", Mock()):
+            self.plugin._extract_cts_results_by_offset(BytesIO(XML_RESULTS.encode()), Mock(), testrun, 'cts', failures_only=True)
+        mock_create_context.assert_called_with(testrun, 6, True)
+        self.assertEqual(expected, attached.pop("passing_tests.txt.gz")[0])
+
+        self.plugin._extract_cts_results(StringIO(XML_RESULTS), testrun, 'cts')
+        mock_create_context.assert_called_with(testrun, 6, False)
+        self.assertEqual({}, attached)
+
+    def test_module_filter(self):
+        module_filter = ModuleFilter()
+        self.assertTrue(module_filter("CtsDeqpTestCases", "arm64-v8a"))
+
+        module_filter = ModuleFilter(exclude="CtsDeqp*")
+        self.assertFalse(module_filter("CtsDeqpTestCases", "arm64-v8a"))
+        self.assertTrue(module_filter("CtsAppTestCases", "arm64-v8a"))
+
+        module_filter = ModuleFilter(include=["arm64-v8a.*"], exclude=["re:Cts(Deqp|Gles)"])
+        self.assertTrue(module_filter("CtsAppTestCases", "arm64-v8a"))
+        self.assertFalse(module_filter("CtsAppTestCases", "armeabi-v7a"))
+        self.assertFalse(module_filter("CtsGlesTestCases", "arm64-v8a"))
+        self.assertFalse(module_filter("CtsAppTestCases"))
+
+    def test_module_filter_invalid_pattern(self):
+        with self.assertLogs(level="ERROR") as logs:
+            module_filter = ModuleFilter(exclude=["re:Cts(Deqp", "CtsGles*"])
+        self.assertIn('Ignoring invalid module pattern "re:Cts(Deqp"', logs.output[0])
+        self.assertTrue(module_filter("CtsDeqpTestCases", "arm64-v8a"))
+        self.assertFalse(module_filter("CtsGlesTestCases", "arm64-v8a"))
+
+    @patch("tradefed.create_progress", Mock())
+    @patch("tradefed.create_ingestion_context", Mock())
+    @patch("tradefed.Tradefed._run_chunks", Mock())
+    @patch("tradefed.Tradefed._create_known_issues")
+    @patch("tradefed.create_testcase_tests_from_range")
+    @patch("tradefed.Tradefed._enqueue_testcases_chunk")
+    @patch("tradefed.SuiteCache")
+    def test_extract_results_module_filter(self, mock_suite_cache, mock_enqueue, mock_task, mock_create_known_issues):
+        mock_enqueue.side_effect = lambda testcases, testrun, suite_slug: (1, suite_slug)
+        module_filter = ModuleFilter(exclude="module_bar")
+
+        self.plugin._extract_cts_results(StringIO(XML_RESULTS), Mock(), 'cts', module_filter=module_filter)
+        mock_suite_cache.return_value.add.assert_called_once_with('cts/arm64-v8a.module_foo')
+        self.assertEqual(['TestCaseBar'], [testcase['name'] for c in mock_enqueue.call_args_list for testcase in c.args[0]])
+        self.assertEqual([], mock_create_known_issues.call_args[0][0])
+
+        mock_suite_cache.reset_mock()
+        self.plugin._extract_cts_results_by_offset(BytesIO(XML_RESULTS.encode()), Mock(), Mock(), 'cts', module_filter=ModuleFilter(exclude="arm64-v8a.module_foo"))
+        mock_suite_cache.return_value.add.assert_called_once_with('cts/arm64-v8a.module_bar')
+        self.assertEqual(['cts/arm64-v8a.module_bar'], [c.args[3] for c in mock_task.s.call_args_list])
+        self.assertEqual(['cts/arm64-v8a.module_bar/TestCaseFoo.ztestSetAndGetBrightnessConfiguration'], mock_create_known_issues.call_args[0][0])
+
+    def test_encode_decode_testcases(self):
+        testcases = [
+            {
+                "name": "TestCaseFoo",
+                "suite": "cts/module_foo",
+                "tests": [
+                    {"result": "pass", "name": "test_bar1"},
+                    {"result": "fail", "name": "test_bar2", "log": "some stack trace"},
+                ],
+            },
+            {"name": "TestCaseEmpty", "tests": []},
+            {
+                "name": "TestCaseBar",
+                "tests": [{"result": "pass", "name": "test_bar1"}],
+            },
+        ]
+
+        expected = [
+            ("TestCaseFoo", "test_bar1", "pass", ""),
+            ("TestCaseFoo", "test_bar2", "fail", "some stack trace"),
+            ("TestCaseBar", "test_bar1", "pass", ""),
+        ]
+
+        storage = encode_testcases(testcases)
+        self.assertTrue(storage.startswith(HEADER))
+        self.assertEqual(expected, decode_tests(storage))
+
+        # Chunks stored by previous versions are still readable
+        self.assertEqual(expected, decode_tests(json.dumps(testcases)))
+
+    def test_encode_testcases_is_compact(self):
+        testcases = [
+            {
+                "name": f"TestCase{i % 10}",
+                "suite": "cts/arm64-v8a.CtsSomeVeryLongModuleNameTestCases",
+                "tests": [{"result": "pass", "name": f"testSomethingLong{j}"} for j in range(20)],
+            }
+            for i in range(100)
+        ]
+        self.assertLess(len(encode_testcases(testcases)) * 10, len(json.dumps(testcases)))
+
+    def test_decode_corrupted_tests(self):
+        with self.assertRaises(ValueError):
+            decode_tests(HEADER + "not base64!")
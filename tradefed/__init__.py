@@ -1,40 +1,86 @@
+import gzip
 import logging
 import os
 import re
 import requests
+import shutil
 import tarfile
-import xmlrpc
+import tempfile
+import xmlrpc.client
 import yaml
-import json
+import itertools
 import xml.etree.ElementTree as ET
+from xml.parsers import expat
 from celery import chord as celery_chord
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from django.core.files import File
+from django.db import transaction
 from io import BytesIO
-from requests.adapters import HTTPAdapter, Retry
-from squad.core.models import Suite, SuiteMetadata, PluginScratch, KnownIssue, TestRun
+from squad.core.models import PluginScratch, KnownIssue, Test, TestRun
 from squad.ci.tasks import update_testjob_status
 from squad.plugins import Plugin as BasePlugin
-from urllib.parse import urljoin, urlparse, parse_qs
+from squadplugins.http import get_session
+from urllib.parse import urlencode, urljoin, urlparse, parse_qs
 
-from .tasks import create_testcase_tests, update_build_status
+from .cache import get_artifact_cache
+from .context import create_ingestion_context
+from .filters import ModuleFilter
+from .progress import create_progress
+from .scratch import encode_testcases
+from .suites import SuiteCache
+from .http import ResumeRestarted, conditional_get, iter_resumable_content
+from .tasks import create_lane, create_testcase_tests, create_testcase_tests_from_range, ingest_lane, update_build_status
 
 
 logger = logging.getLogger()
-__session__ = None
 
+# Downloaded tarballs are kept in memory up to this size, then spooled to disk
+DEFAULT_SPOOL_MAX_SIZE = 32 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
-def get_session():
-    global __session__
-    if __session__ is None:
-        retry_strategy = Retry(
-            total=5,
-            backoff_factor=1,
-            status_forcelist=[429, 500, 502, 503, 504])
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        __session__ = requests.Session()
-        __session__.mount('http://', adapter)
-        __session__.mount('https://', adapter)
-    return __session__
+# Number of LAVA REST pages requested at the same time
+DEFAULT_PAGINATION_WORKERS = 4
+
+# Number of LAVA XML-RPC result pages requested in a single system.multicall
+DEFAULT_XMLRPC_BATCH_SIZE = 4
+
+# Number of tests whose log is written per UPDATE, and read per query
+DEFAULT_BULK_UPDATE_BATCH_SIZE = 500
+FAILED_TESTS_CHUNK_SIZE = 2000
+
+# Maximum number of test names in a single IN query for known issues
+KNOWN_ISSUES_QUERY_BATCH_SIZE = 1000
+
+# Default limits of a chunk of tests sent to a sub-task, overridden per project
+# with PLUGINS_TRADEFED_CHUNK_MAX_TESTS and PLUGINS_TRADEFED_CHUNK_MAX_BYTES
+DEFAULT_CHUNK_MAX_TESTS = 1000
+DEFAULT_CHUNK_MAX_BYTES = 1024 * 1024
+
+# <Module> attributes published in the testrun metadata before tests are extracted
+MODULE_SUMMARY_ATTRIBUTES = ('pass', 'total_tests', 'done')
+
+# Attachment listing the passing tests of projects with PLUGINS_TRADEFED_FAILURES_ONLY
+PASSING_TESTS_FILENAME = "passing_tests.txt.gz"
+
+# Default number of chunks of a testrun processed at the same time, overridden
+# per project with PLUGINS_TRADEFED_MAX_CHUNKS_IN_FLIGHT
+DEFAULT_MAX_CHUNKS_IN_FLIGHT = 16
+
+# Tarball members of interest and the ResultFiles attribute they're stored in
+RESULT_MEMBERS = [
+    ("test_result.xml", "test_results"),
+    ("compatibility_result.xsl", "test_result_xslt"),
+    ("compatibility_result.css", "test_result_css"),
+    ("logo.png", "test_result_image"),
+    ("tradefed-stdout.txt", "tradefed_stdout"),
+    ("tradefed-logcat.txt", "tradefed_logcat"),
+]
+
+
+def get_spooled_file():
+    max_size = getattr(settings, "PLUGINS_TRADEFED_SPOOL_MAX_SIZE", DEFAULT_SPOOL_MAX_SIZE)
+    return tempfile.SpooledTemporaryFile(max_size=max_size)
 
 
 class PaginatedObjectException(Exception):
@@ -65,15 +111,128 @@ class Tradefed(BasePlugin):
     def has_subtasks(self):
         return True
 
-    def __iterate_test_names(self, tradefed_tree, test_suite_name_list, test_name_list, join_char):
+    def __iterate_test_names(self, test_suite_name_list, test_name_list, join_char):
         prefix_string = "/".join(test_suite_name_list[2:])
         prefixes = prefix_string.split(".")
         for index in range(0, len(prefixes)):
-            test_name = ".".join(prefixes[index:]) + join_char + ".".join(test_name_list)
-            logger.debug("searching for test: %s" % test_name)
-            log_node = tradefed_tree.find('.//Test[@name="%s"]' % test_name)
-            if log_node is not None:
-                return log_node
+            yield ".".join(prefixes[index:]) + join_char + ".".join(test_name_list)
+
+    def __get_test_lookup(self, test):
+        """
+            Work out where the log of `test` might be in test_result.xml. Returns None
+            if the test doesn't come from tradefed, or a tuple with:
+              * the (module name, abi) key of its <Module>, abi being None if absent
+              * the name of the <Test> to look for within that module
+              * other <Test> names to look for anywhere in the file, in order
+        """
+        test_suite_name_list = str(test.suite).split("/")
+        if len(test_suite_name_list) <= 1:
+            # assume that test results produced by LAVA
+            # and test-definitions always contain at least one "/"
+            return None
+        test_suite_name = test_suite_name_list[1]
+        test_suite_abi = None
+        if "." in test_suite_name:
+            test_suite_abi, test_suite_name = test_suite_name.split(".")
+        test_name_list = test.name.rsplit(".")
+        fallback_names = [".".join(test_name_list[1:])]
+        fallback_names += self.__iterate_test_names(test_suite_name_list, test_name_list, ".")
+        fallback_names += self.__iterate_test_names(test_suite_name_list, test_name_list, "/")
+        return (test_suite_name, test_suite_abi), test_name_list[-1], fallback_names
+
+    def __get_stack_trace(self, test_node):
+        trace_node = test_node.find('.//StackTrace')
+        if trace_node is None:
+            return None
+        return trace_node.text
+
+    def __index_xml_results(self, tradefed_tree):
+        """
+            Walk the tree once and index the stack traces of <Test> nodes by name, so
+            that looking up the log of each failed test is a dictionary access rather
+            than an XPath search over the whole tree.
+
+            Returns three dicts:
+              * modules: (module name, abi) -> whether the <Module> has any children,
+                where (module name, None) stands for the first module with that name
+              * module_logs: ((module name, abi), test name) -> stack trace
+              * logs: test name -> stack trace of the first <Test> with that name
+
+            Stack traces are None for tests that don't have one. Only the first node
+            for each key is kept, same as Element.find() would return.
+        """
+        modules = {}
+        module_logs = {}
+        for module_node in tradefed_tree.iter('Module'):
+            name = module_node.get('name')
+            module_keys = [key for key in [(name, module_node.get('abi')), (name, None)] if key not in modules]
+            for key in module_keys:
+                modules[key] = len(module_node) > 0
+
+            for test_node in module_node.iter('Test'):
+                for key in module_keys:
+                    module_logs.setdefault((key, test_node.get('name')), self.__get_stack_trace(test_node))
+
+        logs = {}
+        for test_node in tradefed_tree.iter('Test'):
+            if test_node.get('name') not in logs:
+                logs[test_node.get('name')] = self.__get_stack_trace(test_node)
+
+        return modules, module_logs, logs
+
+    def __stream_xml_results(self, buf, lookups):
+        """
+            Same as __index_xml_results, but reads buf incrementally and only keeps
+            the stack traces of the tests listed in `lookups` (as returned by
+            __get_test_lookup). Elements are cleared as soon as they are parsed, so
+            memory usage doesn't depend on the size of test_result.xml.
+        """
+        wanted_module_tests = set()
+        wanted_names = set()
+        for module_key, test_name, fallback_names in lookups:
+            wanted_module_tests.add((module_key, test_name))
+            wanted_names.update(fallback_names)
+
+        modules = {}
+        module_logs = {}
+        logs = {}
+        module_keys = []
+        # Open elements, so that finished ones can be removed from their parent:
+        # clearing alone leaves empty elements attached until the Module ends
+        parents = []
+        for event, element in ET.iterparse(buf, events=['start', 'end']):
+            if event == 'start':
+                parents.append(element)
+                if element.tag == 'Module':
+                    name = element.get('name')
+                    module_keys = [key for key in [(name, element.get('abi')), (name, None)] if key not in modules]
+                    for key in module_keys:
+                        modules[key] = False
+                else:
+                    for key in module_keys:
+                        modules[key] = True
+                continue
+
+            parents.pop()
+            if element.tag == 'Test':
+                name = element.get('name')
+                keys = [(key, name) for key in module_keys if (key, name) in wanted_module_tests]
+                if len(keys) or name in wanted_names:
+                    trace = self.__get_stack_trace(element)
+                    for key in keys:
+                        module_logs.setdefault(key, trace)
+                    if name in wanted_names and name not in logs:
+                        logs[name] = trace
+
+            elif element.tag == 'Module':
+                module_keys = []
+
+            if element.tag in ('Test', 'TestCase', 'Module'):
+                element.clear()
+                if len(parents):
+                    parents[-1].remove(element)
+
+        return modules, module_logs, logs
 
     def _convert_paths(self, testrun, results):
         base_url = f"{settings.BASE_URL}/{testrun.build.project.group.slug}/{testrun.build.project.slug}/build/{testrun.build.version}/attachments/testrun/{testrun.id}"
@@ -110,35 +269,114 @@ class Tradefed(BasePlugin):
         buf.seek(0)
         return tradefed_tree
 
-    def _enqueue_testcases_chunk(self, testcases, testrun, suite):
+    def _enqueue_testcases_chunk(self, testcases, testrun, suite_slug):
+        """
+            Save testcases to a PluginScratch and return a (scratch id, suite slug)
+            tuple. Tasks are only created once the suites are all in the database.
+        """
         plugin_scratch = PluginScratch.objects.create(
             build=testrun.build,
-            storage=json.dumps(testcases),
+            storage=encode_testcases(testcases),
         )
 
         logger.debug(f"Created plugin scratch with ID: {plugin_scratch}")
-        task = create_testcase_tests.s(plugin_scratch.id, suite.slug, testrun.id, suite.id)
-        del plugin_scratch
-        return task
+        return plugin_scratch.id, suite_slug
+
+    def _run_chunks(self, task_list, testrun, context_id, max_in_flight):
+        """
+            Spread the chunk tasks over at most max_in_flight lanes, each running its
+            chunks one at a time, and update the build status once all are done.
+        """
+
+        lanes = [task_list[index::max_in_flight] for index in range(min(max_in_flight, len(task_list)))]
+        logger.debug(f"Running {len(task_list)} chunks in {len(lanes)} lanes")
+        lane_tasks = [ingest_lane.s(create_lane(testrun.build, lane)) for lane in lanes]
+        celery_chord(lane_tasks)(update_build_status.s(testrun.pk, self.extra_args.get("job_id"), self.extra_args.get("job_status"), context_id))
+
+    def _read_summary(self, buf):
+        """
+            Return the attributes of the <Summary> tag of buf, and the pass, total_tests
+            and done attributes of each <Module> by "<abi>.<name>". Only start tags are
+            looked at, so this is much quicker than extracting the results.
+        """
+
+        def numbers(attrib):
+            return {key: int(value) if value.isdigit() else value for key, value in attrib.items()}
+
+        summary = {}
+        modules = {}
+
+        def start_element(tag, attrib):
+            if tag == 'Summary':
+                summary.update(numbers(attrib))
+            elif tag == 'Module':
+                module_name = attrib['name']
+                if 'abi' in attrib:
+                    module_name = attrib['abi'] + '.' + module_name
+                modules[module_name] = numbers({key: attrib[key] for key in MODULE_SUMMARY_ATTRIBUTES if key in attrib})
+
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = start_element
+
+        buf.seek(0)
+        try:
+            parser.ParseFile(buf)
+        except expat.ExpatError as e:
+            logger.warning(f"[CTS/VTS] Error reading summary: {e}")
+        buf.seek(0)
+
+        return summary, modules
+
+    def _open_passing_tests(self):
+        spool = get_spooled_file()
+        return spool, gzip.GzipFile(fileobj=spool, mode='wb')
+
+    def _attach_passing_tests(self, testrun, passing_tests):
+        """
+            Save the names written to passing_tests, as returned by _open_passing_tests,
+            in a gzipped attachment of testrun, one per line.
+        """
+
+        spool, writer = passing_tests
+        writer.close()
+
+        extracted = ExtractedResult()
+        extracted.contents = spool
+        extracted.length = spool.tell()
+        self._create_testrun_attachment(testrun, PASSING_TESTS_FILENAME, extracted, "application/gzip")
 
-    def _extract_cts_results(self, buf, testrun, suite_prefix):
+    def _extract_cts_results(self, buf, testrun, suite_prefix, max_tests=DEFAULT_CHUNK_MAX_TESTS, max_bytes=DEFAULT_CHUNK_MAX_BYTES, max_in_flight=DEFAULT_MAX_CHUNKS_IN_FLIGHT, failures_only=False, module_filter=None):
         """
             This function reads in buf and iteractively parses the XML file so that
-            it does not eat up lots of memory (+1G). The tags are grouped in chunks
-            of 1000 TestCase and then sent to the queue for sub-tasks to process them.
+            it does not eat up lots of memory (+1G). The TestCase tags of each Module are
+            grouped in chunks and then sent to the queue for sub-tasks to process them.
+            A new chunk is started once the current one has max_tests tests or about
+            max_bytes of names and stack traces.
 
             The PluginScratch serves as a helper to share data among the sub-tasks. Data
-            will be transformed to JSON when saved to plugin scratch.
+            is saved to plugin scratch in the compact format from tradefed.scratch.
+
+            Suites are looked up in a SuiteCache, so changing modules doesn't hit the
+            database; the ones missing get created in batches along the way.
+
+            With failures_only, sub-tasks only create failed and skipped tests, and the
+            names of passing tests are saved in a PASSING_TESTS_FILENAME attachment.
+
+            Modules rejected by module_filter, a ModuleFilter, are skipped entirely.
         """
 
-        chunk_size = 100
         module_name = ''
+        chunk_tests = 0
+        chunk_bytes = 0
         testcases = []
         testcase = None
         test = None
-        task_list = []
-        suite = None
+        chunks = []
         suite_slug = ''
+        assumption_failures = []
+        suites = SuiteCache(testrun.build.project, suite_prefix)
+        passing_tests = self._open_passing_tests() if failures_only else None
+        skip_module = False
 
         try:
             for event, element in ET.iterparse(buf, events=['start']):
@@ -146,54 +384,61 @@ class Tradefed(BasePlugin):
 
                     # When changing modules, enqueue whatever testcases might be in buffer
                     if len(testcases) > 0:
-                        task = self._enqueue_testcases_chunk(testcases, testrun, suite)
-                        task_list.append(task)
+                        chunks.append(self._enqueue_testcases_chunk(testcases, testrun, suite_slug))
                         testcases = []
+                        chunk_tests = chunk_bytes = 0
 
                     module_name = element.attrib['name']
+                    skip_module = module_filter is not None and not module_filter(module_name, element.attrib.get('abi'))
+                    if skip_module:
+                        logger.debug(f"Skipping module: {module_name}")
+                        element.clear()
+                        continue
+
                     logger.debug(f"Module: {module_name}")
 
                     if 'abi' in element.attrib.keys():
                         module_name = element.attrib['abi'] + '.' + module_name
 
                     suite_slug = f"{suite_prefix}/{module_name}"
-                    logger.debug(f"Creating suite metadata: {suite_slug}")
+                    suites.add(suite_slug)
 
-                    metadata, _ = SuiteMetadata.objects.get_or_create(suite=suite_slug, kind='suite')
-                    suite, _ = Suite.objects.get_or_create(slug=suite_slug, project=testrun.build.project, defaults={"metadata": metadata})
+                elif skip_module:
+                    element.clear()
+                    continue
 
                 if element.tag == 'TestCase':
-                    # Check if there's enough test cases to send to the queue
-                    if len(testcases) == chunk_size:
-                        logger.debug(f'Enqueueing {len(testcases)} TestCase tags')
-                        task = self._enqueue_testcases_chunk(testcases, testrun, suite)
-                        task_list.append(task)
+                    # Check if there's enough tests to send to the queue
+                    if len(testcases) > 0 and (chunk_tests >= max_tests or chunk_bytes >= max_bytes):
+                        logger.debug(f'Enqueueing {len(testcases)} TestCase tags, {chunk_tests} tests')
+                        chunks.append(self._enqueue_testcases_chunk(testcases, testrun, suite_slug))
                         testcases = []
+                        chunk_tests = chunk_bytes = 0
 
                     testcase = element.attrib
                     testcase['tests'] = []
                     testcase['suite'] = suite_slug
                     testcases.append(testcase)
+                    chunk_bytes += len(testcase.get('name', ''))
 
                 if element.tag == 'Test':
                     test = element.attrib
                     testcase['tests'].append(test)
+                    chunk_tests += 1
+                    chunk_bytes += len(test.get('name', ''))
 
                     if test.get("result") == "ASSUMPTION_FAILURE":
 
                         # ASSUMPTION_FAILURE will be added to the known issues list so they can show up
                         # as xfail tests
-                        test_full_name = f"{suite_slug}/{testcase.get('name')}.{test.get('name')}"
-                        issue, _ = KnownIssue.objects.get_or_create(
-                            title=f'Tradefed/{test_full_name}',
-                            test_name=test_full_name,
-                        )
+                        assumption_failures.append(f"{suite_slug}/{testcase.get('name')}.{test.get('name')}")
 
-                        issue.environments.add(testrun.environment)
-                        issue.save()
+                    elif test.get("result") == "pass" and passing_tests is not None:
+                        passing_tests[1].write(f"{suite_slug}/{testcase.get('name')}.{test.get('name')}\n".encode())
 
                 if element.tag == 'StackTrace':
                     test['log'] = element.text
+                    chunk_bytes += len(element.text or '')
 
                 # Release tag resources
                 element.clear()
@@ -204,60 +449,220 @@ class Tradefed(BasePlugin):
 
         # Process remaining test cases that didn't make to the last chunk
         if len(testcases) > 0:
-            task = self._enqueue_testcases_chunk(testcases, testrun, suite)
-            task_list.append(task)
+            chunks.append(self._enqueue_testcases_chunk(testcases, testrun, suite_slug))
+
+        if passing_tests is not None:
+            self._attach_passing_tests(testrun, passing_tests)
+
+        # Suites and known issues need to be in place before the chunks get processed
+        suites.flush()
+        self._create_known_issues(assumption_failures, testrun.environment)
+
+        progress_id = create_progress(testrun, len(chunks))
+        context_id = create_ingestion_context(testrun, progress_id, failures_only)
+
+        task_list = []
+        for scratch_id, suite_slug in chunks:
+            task_list.append(create_testcase_tests.s(scratch_id, suite_slug, testrun.id, suites.get(suite_slug).id, context_id))
+
+        self._run_chunks(task_list, testrun, context_id, max_in_flight)
+
+    def _extract_cts_results_by_offset(self, buf, attachment, testrun, suite_prefix, max_tests=DEFAULT_CHUNK_MAX_TESTS, max_bytes=DEFAULT_CHUNK_MAX_BYTES, max_in_flight=DEFAULT_MAX_CHUNKS_IN_FLIGHT, failures_only=False, module_filter=None):
+        """
+            Like _extract_cts_results, but tests are not passed to the sub-tasks through
+            the database. buf is only scanned for the byte offsets of TestCase tags, which
+            are grouped in ranges of the same Module, up to max_tests tests or about
+            max_bytes long. Each sub-task then reads and parses its own range of
+            attachment, the stored copy of buf.
+        """
+
+        ranges = []
+        assumption_failures = []
+        suites = SuiteCache(testrun.build.project, suite_prefix)
+        passing_tests = self._open_passing_tests() if failures_only else None
+
+        suite_slug = ''
+        testcase_name = ''
+        skip_module = False
+        range_start = None
+        range_tests = 0
+        parser = expat.ParserCreate()
+
+        def close_range(end):
+            nonlocal range_start, range_tests
+            if range_start is not None:
+                ranges.append((range_start, end, suite_slug))
+            range_start = None
+            range_tests = 0
+
+        def start_element(tag, attrib):
+            nonlocal suite_slug, testcase_name, skip_module, range_start, range_tests
+            if tag == 'Module':
+                close_range(parser.CurrentByteIndex)
+
+                module_name = attrib['name']
+                skip_module = module_filter is not None and not module_filter(module_name, attrib.get('abi'))
+                if skip_module:
+                    logger.debug(f"Skipping module: {module_name}")
+                    return
+
+                if 'abi' in attrib:
+                    module_name = attrib['abi'] + '.' + module_name
+
+                suite_slug = f"{suite_prefix}/{module_name}"
+                suites.add(suite_slug)
+
+            elif skip_module:
+                return
+
+            elif tag == 'TestCase':
+                if range_start is not None and (range_tests >= max_tests or parser.CurrentByteIndex - range_start >= max_bytes):
+                    close_range(parser.CurrentByteIndex)
+                if range_start is None:
+                    range_start = parser.CurrentByteIndex
+                testcase_name = attrib.get('name')
+
+            elif tag == 'Test':
+                range_tests += 1
+                if attrib.get('result') == 'ASSUMPTION_FAILURE':
+                    assumption_failures.append(f"{suite_slug}/{testcase_name}.{attrib.get('name')}")
+                elif attrib.get('result') == 'pass' and passing_tests is not None:
+                    passing_tests[1].write(f"{suite_slug}/{testcase_name}.{attrib.get('name')}\n".encode())
+
+        def end_element(tag):
+            if tag == 'Module':
+                close_range(parser.CurrentByteIndex)
+
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+
+        buf.seek(0)
+        try:
+            parser.ParseFile(buf)
+        except expat.ExpatError as e:
+            logger.error(f"[CTS/VTS] Error scanning cases: {e}")
+            return None
+
+        logger.debug(f"Found {len(ranges)} ranges of TestCase tags")
+
+        if passing_tests is not None:
+            self._attach_passing_tests(testrun, passing_tests)
+
+        # Suites and known issues need to be in place before the ranges get processed
+        suites.flush()
+        self._create_known_issues(assumption_failures, testrun.environment)
+
+        progress_id = create_progress(testrun, len(ranges))
+        context_id = create_ingestion_context(testrun, progress_id, failures_only)
 
-        celery_chord(task_list)(update_build_status.s(testrun.pk, self.extra_args.get("job_id"), self.extra_args.get("job_status")))
+        task_list = []
+        for start, end, suite_slug in ranges:
+            task_list.append(create_testcase_tests_from_range.s(attachment.id, start, end, suite_slug, testrun.id, suites.get(suite_slug).id, context_id))
+
+        self._run_chunks(task_list, testrun, context_id, max_in_flight)
+
+    def _create_known_issues(self, test_names, environment):
+        """
+            Make sure there's a "Tradefed/<test name>" known issue for each of test_names,
+            active in `environment`. Existing issues are fetched with IN queries, the
+            missing ones are created with a single bulk_create, and all of them are
+            linked to the environment with one insert into the M2M table.
+        """
+        test_names = set(test_names)
+        if len(test_names) == 0:
+            return
+
+        def fetch(names):
+            names = sorted(names)
+            issues = {}
+            for index in range(0, len(names), KNOWN_ISSUES_QUERY_BATCH_SIZE):
+                for issue in KnownIssue.objects.filter(test_name__in=names[index:index + KNOWN_ISSUES_QUERY_BATCH_SIZE]):
+                    if issue.title == f'Tradefed/{issue.test_name}':
+                        issues.setdefault(issue.test_name, issue)
+            return issues
+
+        issues = fetch(test_names)
+        missing = test_names - set(issues.keys())
+        if len(missing) > 0:
+            logger.debug(f"Creating {len(missing)} known issues for ASSUMPTION_FAILURE tests")
+            KnownIssue.objects.bulk_create([KnownIssue(title=f'Tradefed/{name}', test_name=name) for name in missing])
+            issues.update(fetch(missing))
+
+        KnownIssueEnvironment = KnownIssue.environments.through
+        KnownIssueEnvironment.objects.bulk_create(
+            [KnownIssueEnvironment(knownissue_id=issue.id, environment_id=environment.id) for issue in issues.values()],
+            ignore_conflicts=True,
+        )
+
+    def _assign_test_log(self, buf, test_list, streaming=False):
+        """
+            Assign the stack traces found in test_result.xml to the tests in test_list.
 
-    def _assign_test_log(self, buf, test_list):
+            By default the whole XML file is loaded and indexed. With `streaming`,
+            the file is instead parsed incrementally keeping only the stack traces
+            of the tests in test_list, which keeps memory usage flat on large results.
+        """
         # assume buf is a file-like object
-        logger.debug("About to parse XML from buffer")
-        tradefed_tree = self.__parse_xml_results(buf)
-        if tradefed_tree is None:
+        if buf is None:
+            logger.warning("Results file doesn't exist")
             return
+
+        lookups = []
         for test in test_list:
-            # search in etree for relevant test
             logger.debug("processing %s/%s" % (test.suite, test.name))
-            test_suite_name_list = str(test.suite).split("/")
-            if len(test_suite_name_list) <= 1:
-                # assume that test results produced by LAVA
-                # and test-definitions always contain at least one "/"
-                continue
-            test_suite_name = test_suite_name_list[1]
-            test_suite_abi = None
-            if "." in test_suite_name:
-                test_suite_abi, test_suite_name = test_suite_name.split(".")
-            test_name_list = test.name.rsplit(".")
-            test_name = test_name_list[-1]
+            lookup = self.__get_test_lookup(test)
+            if lookup is not None:
+                lookups.append((test, lookup))
+
+        if streaming:
+            logger.debug("About to stream XML from buffer")
+            try:
+                modules, module_logs, logs = self.__stream_xml_results(buf, [lookup for _, lookup in lookups])
+            except ET.ParseError as e:
+                logger.warning(e)
+                return
+            finally:
+                buf.seek(0)
+        else:
+            logger.debug("About to parse XML from buffer")
+            tradefed_tree = self.__parse_xml_results(buf)
+            if tradefed_tree is None:
+                return
+            modules, module_logs, logs = self.__index_xml_results(tradefed_tree)
+
+        updated_tests = []
+        for test, (module_key, test_name, fallback_names) in lookups:
+            # search for relevant test
+            # Module name="VtsKernelLtp" abi="armeabi-v7a"
             logger.debug("searching for %s log" % test_name)
-            suite_node = None
-            if test_suite_abi is not None:
-                # Module name="VtsKernelLtp" abi="armeabi-v7a"
-                suite_node = tradefed_tree.find('.//Module[@name="%s"][@abi="%s"]' % (test_suite_name, test_suite_abi))
-            else:
-                suite_node = tradefed_tree.find('.//Module[@name="%s"]' % (test_suite_name))
-            if not suite_node:
-                logger.debug("Module %s is not present in the log" % test_suite_name)
+            if not modules.get(module_key):
+                logger.debug("Module %s is not present in the log" % module_key[0])
                 continue
-            log_node = suite_node.find('.//Test[@name="%s"]' % test_name)
-            if log_node is None:
-                test_name = ".".join(test_name_list[1:])
-                logger.debug("searching for test: %s" % test_name)
-                log_node = tradefed_tree.find('.//Test[@name="%s"]' % test_name)
-            if log_node is None:
-                log_node = self.__iterate_test_names(tradefed_tree, test_suite_name_list, test_name_list, ".")
-            if log_node is None:
-                log_node = self.__iterate_test_names(tradefed_tree, test_suite_name_list, test_name_list, "/")
-
-            if log_node is not None:
-                trace_node = log_node.find('.//StackTrace')
-                if trace_node is not None:
-                    test.log = trace_node.text
-                    test.save()
+
+            key = (module_key, test_name)
+            if key in module_logs:
+                log = module_logs[key]
+            else:
+                log = next((logs[name] for name in fallback_names if name in logs), None)
+
+            if log is not None:
+                test.log = log
+                updated_tests.append(test)
+
+        if len(updated_tests) > 0:
+            self._save_test_logs(updated_tests)
+
+    def _save_test_logs(self, tests):
+        batch_size = getattr(settings, "PLUGINS_BULK_UPDATE_BATCH_SIZE", DEFAULT_BULK_UPDATE_BATCH_SIZE)
+        logger.debug(f"Saving logs of {len(tests)} tests")
+        with transaction.atomic():
+            Test.objects.bulk_update(tests, ['log'], batch_size=batch_size)
 
     def _extract_member(self, tar_file, tar_member):
         extracted_container = ExtractedResult()
-        extracted_container.contents = tar_file.extractfile(tar_member)
+        extracted_container.contents = get_spooled_file()
+        shutil.copyfileobj(tar_file.extractfile(tar_member), extracted_container.contents, DOWNLOAD_CHUNK_SIZE)
+        extracted_container.contents.seek(0)
         extracted_container.length = tar_member.size
         return extracted_container
 
@@ -284,6 +689,102 @@ class Tradefed(BasePlugin):
         logger.debug("Giving up trying to look for tradefed filename in {url}")
         return None
 
+    def _spool_response(self, session, response):
+        """
+            Write the response body in chunks to a temporary file that stays in
+            memory up to PLUGINS_TRADEFED_SPOOL_MAX_SIZE bytes and rolls over to
+            disk after that, so large tarballs don't live entirely in RAM.
+        """
+        spool = get_spooled_file()
+        for chunk in iter_resumable_content(session, response, DOWNLOAD_CHUNK_SIZE):
+            spool.write(chunk)
+
+        length = spool.tell()
+        spool.seek(0)
+        return spool, length
+
+    def _fetch_tarball(self, session, url):
+        """
+            Download the tarball at `url`, or get it from the local artifact cache if
+            it was downloaded before. Returns a tuple (contents, length, filename, mimetype)
+            or None if the download failed.
+
+            Cached tarballs are served without touching the network, unless
+            PLUGINS_TRADEFED_CACHE_REVALIDATE is set, in which case a conditional
+            request checks that the cached copy is still current.
+        """
+        cache = get_artifact_cache()
+        cached = None
+        if cache is not None:
+            try:
+                cached = cache.get(url)
+            except OSError as e:
+                logger.error(f"Unable to read artifact cache for {url}, not using it: {e}")
+                cache = None
+
+        headers = {}
+        if cached is not None:
+            contents, entry = cached
+            if not getattr(settings, "PLUGINS_TRADEFED_CACHE_REVALIDATE", False):
+                return contents, entry['length'], entry.get('filename'), entry.get('mimetype')
+
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = session.get(url, headers=headers, stream=True)
+        except Exception:
+            if cached is not None:
+                contents.close()
+            raise
+
+        if response.status_code == 304 and cached is not None:
+            logger.debug(f"Cached copy of {url} is still valid")
+            response.close()
+            return contents, entry['length'], entry.get('filename'), entry.get('mimetype')
+
+        if cached is not None:
+            contents.close()
+
+        if response.status_code != 200:
+            logger.error(f"Failed to download tradefed file {url}")
+            response.close()
+            return None
+
+        filename = self._extract_tarball_filename_from_url(response.url)
+        mime_type = response.headers.get("Content-Type")
+        try:
+            if cache is not None:
+                try:
+                    contents, entry = cache.put(
+                        url,
+                        iter_resumable_content(session, response, DOWNLOAD_CHUNK_SIZE),
+                        etag=response.headers.get("ETag"),
+                        last_modified=response.headers.get("Last-Modified"),
+                        filename=filename,
+                        mimetype=mime_type,
+                    )
+                    return contents, entry['length'], filename, mime_type
+                except requests.exceptions.RequestException:
+                    raise
+                except OSError as e:
+                    # Part of the body went to the cache already, so start over
+                    logger.error(f"Unable to write {url} to the artifact cache, downloading it again without it: {e}")
+                    response.close()
+                    response = session.get(url, stream=True)
+                    if response.status_code != 200:
+                        logger.error(f"Failed to download tradefed file {url}")
+                        response.close()
+                        return None
+
+            contents, length = self._spool_response(session, response)
+            return contents, length, filename, mime_type
+        except ResumeRestarted as e:
+            logger.error(f"Failed to resume download of {e}")
+            return None
+
     def _download_results(self, url):
         results = ResultFiles()
         session = get_session()
@@ -292,6 +793,7 @@ class Tradefed(BasePlugin):
             self.tradefed_results_url = url
 
             contents = None
+            length = None
             mime_type = None
             filename = None
             if url.startswith(settings.BASE_URL):
@@ -315,57 +817,44 @@ class Tradefed(BasePlugin):
                     return results
 
                 attachment = attachments.first()
-                contents = attachment.data
+                # Copy it in chunks, the tarball can be too big for attachment.data
+                contents = get_spooled_file()
+                if attachment.storage:
+                    with attachment.storage.open('rb') as fp:
+                        shutil.copyfileobj(fp, contents, DOWNLOAD_CHUNK_SIZE)
+                length = contents.tell()
+                contents.seek(0)
                 mime_type = attachment.mimetype
                 filename = os.path.basename(attachment.filename)
 
             else:
-                response = session.get(self.tradefed_results_url)
-                if response.status_code != 200:
-                    logger.error(f"Failed to download tradefed file {self.tradefed_results_url}")
+                fetched = self._fetch_tarball(session, url)
+                if fetched is None:
                     return results
 
-                response.raw.decode_content = True
-                contents = response.content
-                filename = self._extract_tarball_filename_from_url(response.url)
-                mime_type = response.headers.get("Content-Type")
+                contents, length, filename, mime_type = fetched
 
-            r = BytesIO(contents)
             results.tradefed_zipfile = ExtractedResult()
-            results.tradefed_zipfile.contents = r
-            results.tradefed_zipfile.length = len(contents)
+            results.tradefed_zipfile.contents = contents
+            results.tradefed_zipfile.length = length
             results.tradefed_zipfile.name = filename
             results.tradefed_zipfile.mimetype = mime_type
 
             logger.debug(f"Retrieved {results.tradefed_zipfile.length} bytes")
 
-            t = tarfile.open(fileobj=r, mode='r:xz')
-            for member in t.getmembers():
+            # Read the archive in a single forward pass: 'r|xz' never seeks back
+            # through the xz stream, so each member has to be consumed right away
+            t = tarfile.open(fileobj=contents, mode='r|xz')
+            for member in t:
 
                 logger.debug(f"Available member: {member.name}")
-                if "test_result.xml" in member.name:
-                    results.test_results = self._extract_member(t, member)
-                    logger.debug("test_results object is empty: %s" % (results.test_results is None))
-
-                if "compatibility_result.xsl" in member.name:
-                    results.test_result_xslt = self._extract_member(t, member)
-                    logger.debug("test_result_xslt object is empty: %s" % (results.test_result_xslt is None))
-
-                if "compatibility_result.css" in member.name:
-                    results.test_result_css = self._extract_member(t, member)
-                    logger.debug("test_result_css object is empty: %s" % (results.test_result_css is None))
+                if not member.isfile():
+                    continue
 
-                if "logo.png" in member.name:
-                    results.test_result_image = self._extract_member(t, member)
-                    logger.debug("test_result_image object is empty: %s" % (results.test_result_image is None))
-
-                if "tradefed-stdout.txt" in member.name:
-                    results.tradefed_stdout = self._extract_member(t, member)
-                    logger.debug("tradefed_stdout object is empty: %s" % (results.tradefed_stdout is None))
-
-                if "tradefed-logcat.txt" in member.name:
-                    results.tradefed_logcat = self._extract_member(t, member)
-                    logger.debug("tradefed_logcat object is empty: %s" % (results.tradefed_logcat is None))
+                for pattern, attr in RESULT_MEMBERS:
+                    if pattern in member.name:
+                        setattr(results, attr, self._extract_member(t, member))
+                        logger.debug(f"{attr} object is empty: {getattr(results, attr) is None}")
 
             logger.debug('Done extracting members')
         except tarfile.TarError as e:
@@ -378,24 +867,98 @@ class Tradefed(BasePlugin):
         return results
 
     def __get_paginated_objects(self, url, lava_implementation):
+        """
+            Return a generator over the objects of a paginated LAVA REST endpoint.
+
+            The first page is requested right away, so PaginatedObjectException is
+            raised here if it fails. The remaining pages are requested concurrently,
+            using their offsets worked out from the first page's `count`, and are
+            yielded in order. Requests for pages not yet consumed are cancelled
+            when the caller stops iterating.
+        """
         session = get_session()
         # this method only applies to REST API
-        object_request = session.get(url, headers=lava_implementation.authentication)
-        objects = []
-        if object_request.status_code == 200:
-            object_list = object_request.json()
-            objects = object_list['results']
+        object_request = conditional_get(session, url, headers=lava_implementation.authentication)
+        if object_request.status_code != 200:
+            raise PaginatedObjectException()
+        return self.__iterate_paginated_objects(session, object_request.json(), lava_implementation)
+
+    def __get_page_urls(self, next_url, count, page_size):
+        parsed = urlparse(next_url)
+        query = parse_qs(parsed.query)
+        if count is None or page_size == 0 or 'offset' not in query:
+            return None
+
+        urls = []
+        for offset in range(int(query['offset'][0]), count, page_size):
+            query['offset'] = [str(offset)]
+            urls.append(parsed._replace(query=urlencode(query, doseq=True)).geturl())
+        return urls
+
+    def __iterate_paginated_objects(self, session, object_list, lava_implementation):
+        yield from object_list['results']
+        if not object_list['next']:
+            return
+
+        page_urls = self.__get_page_urls(object_list['next'], object_list.get('count'), len(object_list['results']))
+        if page_urls is None:
+            # no offsets to work with, follow the links one by one
             while object_list['next']:
-                object_request = session.get(object_list['next'], headers=lava_implementation.authentication)
-                if object_request.status_code == 200:
-                    object_list = object_request.json()
-                    objects = objects + object_list['results']
-                else:
+                object_request = conditional_get(session, object_list['next'], headers=lava_implementation.authentication)
+                if object_request.status_code != 200:
                     # don't raise exception as some results were extracted
                     break
-        else:
-            raise PaginatedObjectException()
-        return objects
+                object_list = object_request.json()
+                yield from object_list['results']
+            return
+
+        workers = getattr(settings, "PLUGINS_TRADEFED_PAGINATION_WORKERS", DEFAULT_PAGINATION_WORKERS)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = [executor.submit(conditional_get, session, page_url, headers=lava_implementation.authentication) for page_url in page_urls]
+        try:
+            for future in futures:
+                object_request = future.result()
+                if object_request.status_code != 200:
+                    # don't raise exception as some results were extracted
+                    break
+                yield from object_request.json()['results']
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def __get_testsuite_results_pages(self, proxy, job_id, suite_name, limit, offset):
+        """
+            Yield pages of results of a LAVA test suite via XML-RPC, starting at `offset`.
+
+            Pages are requested PLUGINS_TRADEFED_XMLRPC_BATCH_SIZE at a time in a single
+            system.multicall round-trip, falling back to one call per page if the
+            server does not support multicall. Stops at the first short or empty page,
+            and whenever the caller stops iterating.
+        """
+        batch_size = getattr(settings, "PLUGINS_TRADEFED_XMLRPC_BATCH_SIZE", DEFAULT_XMLRPC_BATCH_SIZE)
+        while True:
+            logger.debug(f"requesting {batch_size} pages of results for {suite_name} with offset of {offset}")
+            multicall = xmlrpc.client.MultiCall(proxy)
+            for index in range(batch_size):
+                multicall.results.get_testsuite_results_yaml(job_id, suite_name, limit, offset + index * limit)
+
+            try:
+                batch = list(multicall())
+            except xmlrpc.client.Fault as e:
+                logger.debug(f"system.multicall is not available ({e}), requesting one page at a time")
+                batch = [proxy.results.get_testsuite_results_yaml(job_id, suite_name, limit, offset)]
+                batch_size = 1
+
+            offset += batch_size * limit
+            for results in batch:
+                yaml_results = yaml.load(results, Loader=yaml.CLoader)
+                if not yaml_results:
+                    return
+
+                yield yaml_results
+                if len(yaml_results) < limit:
+                    return
 
     def _get_from_artifactorial(self, testjob, suite_name):
         logger.debug("Retrieving result summary for job: %s" % testjob.job_id)
@@ -443,27 +1006,24 @@ class Tradefed(BasePlugin):
                         logger.error(f"Something went wrong with results.get_testsuite_results_yaml from LAVA for job {testjob.id}")
                         return None
 
-                    while True:
-                        if len(yaml_results) > 0:
-                            for result in yaml_results:
-                                if result['name'] == 'test-attachment':
-                                    if result['result'] == 'pass' and 'reference' in result['metadata']:
-                                        return self._download_results(result['metadata']['reference'])
-                                    return None
-                            offset = offset + limit
-                            logger.debug("requesting results for %s with offset of %s"
-                                         % (suite['name'], offset))
-                            results = testjob.backend.get_implementation().proxy.results.get_testsuite_results_yaml(
-                                testjob.job_id,
-                                suite['name'],
-                                limit,
-                                offset)
-                            yaml_results = yaml.load(results, Loader=yaml.CLoader)
-                        else:
-                            break
+                    pages = [yaml_results]
+                    if len(yaml_results) >= limit:
+                        pages = itertools.chain(pages, self.__get_testsuite_results_pages(
+                            testjob.backend.get_implementation().proxy,
+                            testjob.job_id,
+                            suite['name'],
+                            limit,
+                            limit))
+
+                    for yaml_results in pages:
+                        for result in yaml_results:
+                            if result['name'] == 'test-attachment':
+                                if result['result'] == 'pass' and 'reference' in result['metadata']:
+                                    return self._download_results(result['metadata']['reference'])
+                                return None
                 else:
                     test_attachment_url = urljoin(testjob.backend.get_implementation().api_url_base, "jobs/{job_id}/suites/{suite_id}/tests/?name=test-attachment".format(job_id=testjob.job_id, suite_id=suite['id']))
-                    test_attachment_request = session.get(test_attachment_url, headers=lava_implementation.authentication)
+                    test_attachment_request = conditional_get(session, test_attachment_url, headers=lava_implementation.authentication)
                     if test_attachment_request.status_code == 200:
                         test_attachmet_results = test_attachment_request.json()
                         for test_result in test_attachmet_results['results']:
@@ -479,14 +1039,15 @@ class Tradefed(BasePlugin):
         logger.debug("actual file size: %s" % extracted_file.contents.tell())
         extracted_file.contents.seek(0)
 
-        data = extracted_file.contents.read()
         attachment = testrun.attachments.create(
             filename=name,
             length=extracted_file.length,
             mimetype=mimetype
         )
 
-        attachment.save_file(name, data)
+        # Let the storage copy the spooled file in chunks instead of reading it whole
+        attachment.save_file(name, File(extracted_file.contents, name=name))
+        return attachment
 
     def _extract_tradefed_from_job_definition(self, testjob):
         """
@@ -638,17 +1199,38 @@ class Tradefed(BasePlugin):
             return
 
         logger.debug("Processing results")
+        extract_aggregated = results.test_results is not None and results_format == "aggregated" and testjob.target.get_setting("PLUGINS_TRADEFED_EXTRACT_AGGREGATED", False)
         testjob.testrun.metadata["tradefed_results_url_%s" % testjob.job_id] = self.tradefed_results_url
+        if extract_aggregated:
+            # Publish the totals right away, tests will take a while to show up
+            summary, modules = self._read_summary(results.test_results.contents)
+            testjob.testrun.metadata["tradefed_summary_%s" % testjob.job_id] = summary
+            testjob.testrun.metadata["tradefed_modules_%s" % testjob.job_id] = modules
         testjob.testrun.save()
 
         results_extracted = False
+        extract_by_offset = False
         if results.test_results is not None:
-            if testjob.target.get_setting("PLUGINS_TRADEFED_EXTRACT_AGGREGATED", False) and results_format == "aggregated":
-                self._extract_cts_results(results.test_results.contents, testjob.testrun, tradefed_name)
+            if extract_aggregated:
+                # Ranges of the stored test_results.xml are parsed by the sub-tasks, so
+                # that needs to wait until the attachment is created
+                extract_by_offset = testjob.target.get_setting("PLUGINS_TRADEFED_EXTRACT_BY_OFFSET", False)
+                max_tests = max(1, int(testjob.target.get_setting("PLUGINS_TRADEFED_CHUNK_MAX_TESTS", DEFAULT_CHUNK_MAX_TESTS)))
+                max_bytes = max(1, int(testjob.target.get_setting("PLUGINS_TRADEFED_CHUNK_MAX_BYTES", DEFAULT_CHUNK_MAX_BYTES)))
+                max_in_flight = max(1, int(testjob.target.get_setting("PLUGINS_TRADEFED_MAX_CHUNKS_IN_FLIGHT", DEFAULT_MAX_CHUNKS_IN_FLIGHT)))
+                failures_only = testjob.target.get_setting("PLUGINS_TRADEFED_FAILURES_ONLY", False)
+                module_filter = ModuleFilter(
+                    include=testjob.target.get_setting("PLUGINS_TRADEFED_INCLUDE_MODULES"),
+                    exclude=testjob.target.get_setting("PLUGINS_TRADEFED_EXCLUDE_MODULES"),
+                )
+                if not extract_by_offset:
+                    self._extract_cts_results(results.test_results.contents, testjob.testrun, tradefed_name, max_tests, max_bytes, max_in_flight, failures_only, module_filter)
                 results_extracted = True
             else:
-                failed = testjob.testrun.tests.filter(result=False)
-                self._assign_test_log(results.test_results.contents, failed)
+                failed = testjob.testrun.tests.filter(result=False).select_related('suite', 'metadata').only(
+                    'id', 'log', 'suite__slug', 'suite__name', 'metadata__name')
+                streaming = testjob.target.get_setting("PLUGINS_TRADEFED_STREAM_TEST_LOGS", False)
+                self._assign_test_log(results.test_results.contents, failed.iterator(chunk_size=FAILED_TESTS_CHUNK_SIZE), streaming=streaming)
 
             self._convert_paths(testjob.testrun, results)
 
@@ -666,9 +1248,17 @@ class Tradefed(BasePlugin):
                 (results.tradefed_zipfile.name or "tradefed.tar.gz", results.tradefed_zipfile, results.tradefed_zipfile.mimetype or "application/x-tar")
             )
 
+        created_attachments = {}
         for filename, attr, mimetype in attachments:
             if attr is not None:
-                self._create_testrun_attachment(testjob.testrun, filename, attr, mimetype)
+                created_attachments[filename] = self._create_testrun_attachment(testjob.testrun, filename, attr, mimetype)
+
+        if extract_by_offset:
+            self._extract_cts_results_by_offset(results.test_results.contents, created_attachments["test_results.xml"], testjob.testrun, tradefed_name, max_tests, max_bytes, max_in_flight, failures_only, module_filter)
+
+        # The tarball may be an open file of the artifact cache, which is done with now
+        if results.tradefed_zipfile is not None:
+            results.tradefed_zipfile.contents.close()
 
         # Update the status even if the job does not have a proper tradefed file to process
         if not results_extracted:
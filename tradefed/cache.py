@@ -0,0 +1,173 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from contextlib import contextmanager
+from django.conf import settings
+
+
+logger = logging.getLogger()
+
+DEFAULT_CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+class ArtifactCache(object):
+    """
+        On-disk cache for downloaded tradefed artifacts, meant to be shared by all
+        workers running on the same node.
+
+        Contents are stored by their sha256 digest under `objects/`, and each
+        downloaded url gets a small json entry under `urls/` pointing to the digest
+        along with the response ETag and Last-Modified headers. All index changes
+        happen under an exclusive flock on `.lock`, so prefork workers never see
+        half-written entries.
+
+        When the objects grow past `max_size` bytes, the least recently used ones
+        are removed. Cache hits bump the object mtime, which is what LRU is based on.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.objects_path = os.path.join(path, 'objects')
+        self.urls_path = os.path.join(path, 'urls')
+        self.lock_path = os.path.join(path, '.lock')
+        os.makedirs(self.objects_path, exist_ok=True)
+        os.makedirs(self.urls_path, exist_ok=True)
+
+    @contextmanager
+    def _lock(self, operation=fcntl.LOCK_EX):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _url_entry_path(self, url):
+        return os.path.join(self.urls_path, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_path, digest)
+
+    def get(self, url):
+        """
+            Return a tuple (file object, entry) for `url`, or None if it is not cached.
+            The entry is a dict with the url, digest, length, etag, last_modified,
+            filename and mimetype of the cached artifact.
+        """
+
+        entry_path = self._url_entry_path(url)
+        with self._lock(fcntl.LOCK_SH):
+            try:
+                with open(entry_path) as fp:
+                    entry = json.load(fp)
+                object_path = self._object_path(entry['digest'])
+                contents = open(object_path, 'rb')
+            except (OSError, ValueError, KeyError):
+                return None
+
+            try:
+                os.utime(object_path)
+            except OSError:
+                pass
+
+        logger.debug(f"Cache hit for {url}: {entry['digest']}")
+        return contents, entry
+
+    def put(self, url, chunks, **attrs):
+        """
+            Write `chunks` (an iterable of bytes) to the cache as the contents of `url`.
+            Extra keyword arguments (etag, last_modified, filename, mimetype) are kept
+            in the url entry. Returns the same tuple as `get`.
+        """
+
+        digest = hashlib.sha256()
+        length = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.download-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    fp.write(chunk)
+                    length += len(chunk)
+
+            entry = dict(attrs)
+            entry.update(url=url, digest=digest.hexdigest(), length=length)
+            object_path = self._object_path(entry['digest'])
+
+            with self._lock():
+                os.replace(tmp_path, object_path)
+                contents = open(object_path, 'rb')
+
+                entry_path = self._url_entry_path(url)
+                fd, tmp_entry_path = tempfile.mkstemp(dir=self.urls_path, prefix='.entry-')
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(entry, fp)
+                os.replace(tmp_entry_path, entry_path)
+
+                self._evict(keep=entry['digest'])
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        logger.debug(f"Cached {length} bytes from {url}: {entry['digest']}")
+        return contents, entry
+
+    def _evict(self, keep=None):
+        # Must be called with the exclusive lock held
+        objects = []
+        total = 0
+        for digest in os.listdir(self.objects_path):
+            try:
+                stat = os.stat(self._object_path(digest))
+            except OSError:
+                continue
+            objects.append((stat.st_mtime, stat.st_size, digest))
+            total += stat.st_size
+
+        objects.sort()
+        evicted = set()
+        for _, size, digest in objects:
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            os.remove(self._object_path(digest))
+            evicted.add(digest)
+            total -= size
+
+        if len(evicted) == 0:
+            return
+
+        logger.debug(f"Evicted {len(evicted)} objects from cache {self.path}")
+        for name in os.listdir(self.urls_path):
+            entry_path = os.path.join(self.urls_path, name)
+            try:
+                with open(entry_path) as fp:
+                    if json.load(fp).get('digest') in evicted:
+                        os.remove(entry_path)
+            except (OSError, ValueError):
+                continue
+
+
+def get_artifact_cache():
+    """
+        Return an ArtifactCache if PLUGINS_TRADEFED_CACHE_DIR is set, None otherwise
+    """
+
+    path = getattr(settings, "PLUGINS_TRADEFED_CACHE_DIR", None)
+    if not path:
+        return None
+
+    max_size = getattr(settings, "PLUGINS_TRADEFED_CACHE_MAX_SIZE", DEFAULT_CACHE_MAX_SIZE)
+    try:
+        return ArtifactCache(path, max_size)
+    except OSError as e:
+        logger.error(f"Unable to use artifact cache at {path}: {e}")
+        return None
@@ -0,0 +1,97 @@
+import json
+import logging
+import threading
+
+from collections import OrderedDict
+
+from squad.core.models import KnownIssue, PluginScratch, TestRun
+
+
+logger = logging.getLogger()
+
+# How many ingestion contexts each worker process keeps around
+CONTEXT_MEMO_SIZE = 16
+
+__contexts__ = OrderedDict()
+__contexts_lock__ = threading.Lock()
+
+
+def build_ingestion_context(testrun, failures_only=False):
+    """
+        Return a dict with what chunk tasks need to know about testrun: its id,
+        build and environment ids, the ids of the active known issues of the
+        environment by test name, how tests are inserted, as set by the
+        PLUGINS_TRADEFED_TEST_LOADER project setting ('bulk_create' or 'copy'), and
+        whether only failures are created.
+    """
+
+    project = testrun.build.project
+
+    known_issues = {}
+    for issue in KnownIssue.active_by_environment(testrun.environment):
+        known_issues.setdefault(issue.test_name, []).append(issue.id)
+
+    return {
+        'testrun_id': testrun.id,
+        'build_id': testrun.build_id,
+        'environment_id': testrun.environment_id,
+        'known_issues': known_issues,
+        'loader': project.get_setting("PLUGINS_TRADEFED_TEST_LOADER", "bulk_create"),
+        'failures_only': bool(failures_only),
+    }
+
+
+def create_ingestion_context(testrun, progress_id=None, failures_only=False):
+    """
+        Store the ingestion context of testrun in a PluginScratch, to be shared by
+        all chunk tasks, and return its id. Known issues must be created before.
+        progress_id is the PluginScratch where chunks count their progress, and
+        failures_only tells whether the extractor only sent failed and skipped tests.
+    """
+
+    context = build_ingestion_context(testrun, failures_only)
+    context['progress_id'] = progress_id
+    plugin_scratch = PluginScratch.objects.create(
+        build=testrun.build,
+        storage=json.dumps(context),
+    )
+
+    logger.debug(f"Created ingestion context for testrun {testrun.id}: {plugin_scratch.id}")
+    return plugin_scratch.id
+
+
+def get_ingestion_context(testrun_id, context_id=None):
+    """
+        Return the ingestion context of testrun_id stored in PluginScratch context_id.
+        Contexts are remembered by the worker, so only the first chunk of a testrun
+        processed by each worker reads it.
+
+        Without context_id, e.g. for chunks queued by previous versions, the context
+        is built from the database every time.
+    """
+
+    if context_id is None:
+        return build_ingestion_context(TestRun.objects.get(pk=testrun_id))
+
+    key = (testrun_id, context_id)
+    with __contexts_lock__:
+        context = __contexts__.get(key)
+        if context is not None:
+            __contexts__.move_to_end(key)
+            return context
+
+    scratch = PluginScratch.objects.get(pk=context_id)
+    context = json.loads(scratch.storage)
+
+    with __contexts_lock__:
+        __contexts__[key] = context
+        while len(__contexts__) > CONTEXT_MEMO_SIZE:
+            __contexts__.popitem(last=False)
+
+    return context
+
+
+def delete_ingestion_context(testrun_id, context_id):
+    with __contexts_lock__:
+        __contexts__.pop((testrun_id, context_id), None)
+    PluginScratch.objects.filter(pk=context_id).delete()
@@ -0,0 +1,50 @@
+import fnmatch
+import logging
+import re
+
+
+logger = logging.getLogger()
+
+
+class ModuleFilter(object):
+    """
+        Decide which tradefed modules get ingested, from lists of include and
+        exclude patterns. Patterns are globs, or regular expressions when prefixed
+        with "re:", and are matched against both the module name and its
+        "<abi>.<name>" form, e.g. "CtsDeqpTestCases" or "arm64-v8a.CtsDeqp*".
+
+        A module is ingested if it matches an include pattern, or if there are
+        none, and it doesn't match any of the exclude patterns. Invalid regular
+        expressions are logged and ignored.
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = self._compile(include)
+        self.exclude = self._compile(exclude)
+
+    def _compile(self, patterns):
+        if not patterns:
+            return []
+
+        if isinstance(patterns, str):
+            patterns = [patterns]
+
+        compiled = []
+        for pattern in patterns:
+            if pattern.startswith('re:'):
+                try:
+                    compiled.append(re.compile(pattern[3:]))
+                except re.error as e:
+                    logger.error(f"Ignoring invalid module pattern \"{pattern}\": {e}")
+            else:
+                compiled.append(re.compile(fnmatch.translate(pattern)))
+        return compiled
+
+    def _matches(self, patterns, names):
+        return any(pattern.match(name) for pattern in patterns for name in names)
+
+    def __call__(self, name, abi=None):
+        names = [name] if abi is None else [name, f"{abi}.{name}"]
+        if self.include and not self._matches(self.include, names):
+            return False
+        return not self._matches(self.exclude, names)
@@ -0,0 +1,121 @@
+import logging
+import requests
+import threading
+
+from collections import OrderedDict
+
+
+logger = logging.getLogger()
+
+# How many validated responses to remember for conditional requests, and how
+# many bytes of bodies at most. Larger responses, e.g. whole Tuxsuite results,
+# are not worth keeping around
+CONDITIONAL_CACHE_SIZE = 256
+CONDITIONAL_CACHE_MAX_BYTES = 16 * 1024 * 1024
+CONDITIONAL_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+
+# How many times an interrupted download is resumed with a Range request
+MAX_RESUMES = 5
+
+__conditional_cache__ = OrderedDict()
+__conditional_cache_bytes__ = 0
+__conditional_cache_lock__ = threading.Lock()
+
+
+class ResumeRestarted(requests.exceptions.RequestException):
+    pass
+
+
+def conditional_get(session, url, headers=None, **kwargs):
+    """
+        GET `url` sending If-None-Match/If-Modified-Since when a previous response
+        for the same request carried an ETag or Last-Modified header. If the server
+        answers 304 Not Modified, the previous response is returned instead, so
+        callers don't need to care whether the body came from the network.
+    """
+
+    headers = dict(headers or {})
+    key = (url, tuple(sorted(headers.items())))
+    with __conditional_cache_lock__:
+        cached = __conditional_cache__.get(key)
+    if cached is not None:
+        if cached.headers.get('ETag'):
+            headers['If-None-Match'] = cached.headers['ETag']
+        if cached.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = cached.headers['Last-Modified']
+
+    response = session.get(url, headers=headers, **kwargs)
+    if response.status_code == 304 and cached is not None:
+        logger.debug(f"Not modified: {url}")
+        return cached
+
+    if response.status_code == 200 and (response.headers.get('ETag') or response.headers.get('Last-Modified')):
+        # Load the body now so it can be served again later on
+        if len(response.content) <= CONDITIONAL_CACHE_MAX_ENTRY_BYTES:
+            remember_response(key, response)
+
+    return response
+
+
+def remember_response(key, response):
+    global __conditional_cache_bytes__
+    with __conditional_cache_lock__:
+        previous = __conditional_cache__.pop(key, None)
+        if previous is not None:
+            __conditional_cache_bytes__ -= len(previous.content)
+
+        __conditional_cache__[key] = response
+        __conditional_cache_bytes__ += len(response.content)
+        while len(__conditional_cache__) > CONDITIONAL_CACHE_SIZE or __conditional_cache_bytes__ > CONDITIONAL_CACHE_MAX_BYTES:
+            _, evicted = __conditional_cache__.popitem(last=False)
+            __conditional_cache_bytes__ -= len(evicted.content)
+
+
+def iter_resumable_content(session, response, chunk_size, max_resumes=MAX_RESUMES):
+    """
+        Yield the body of a streamed `response` in chunks. If the connection drops
+        midway, the download is resumed from the last received byte with a Range
+        request, using If-Range so that a changed file is never stitched together
+        with the old one.
+
+        Downloads that can't be resumed safely raise ResumeRestarted, since the
+        chunks already yielded would not match what follows: responses without an
+        ETag or Last-Modified, content-encoded responses (offsets count decoded
+        bytes), and servers that answer the range with the whole file or with a
+        Content-Range that doesn't start at the last received byte.
+    """
+
+    url = response.url
+    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+    encoding = response.headers.get('Content-Encoding', 'identity')
+    received = 0
+    resumes = 0
+
+    while True:
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                received += len(chunk)
+                yield chunk
+            return
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            response.close()
+            if resumes >= max_resumes:
+                raise
+            if validator is None:
+                raise ResumeRestarted(f"{url}: no ETag or Last-Modified to resume from") from e
+            if encoding != 'identity':
+                raise ResumeRestarted(f"{url}: {encoding} encoded responses can't be resumed") from e
+
+            resumes += 1
+            logger.warning(f"Download of {url} interrupted at {received} bytes ({e}), resuming")
+            headers = {'Range': f'bytes={received}-', 'If-Range': validator}
+            response = session.get(url, headers=headers, stream=True)
+            if response.status_code == 206 and response.headers.get('Content-Range', '').startswith(f'bytes {received}-'):
+                continue
+
+            response.close()
+            if response.status_code == 200:
+                raise ResumeRestarted(f"{url}: file changed on the server")
+            if response.status_code == 206:
+                raise ResumeRestarted(f"{url}: resumed at {response.headers.get('Content-Range')} instead of byte {received}")
+            raise
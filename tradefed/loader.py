@@ -0,0 +1,64 @@
+import logging
+
+from django.db import connection, transaction
+from io import StringIO
+
+from squad.core.models import Test
+
+
+logger = logging.getLogger()
+
+# Characters that need escaping in the text format of COPY
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\n': '\\n', '\r': '\\r', '\t': '\\t'})
+
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    return str(value).translate(COPY_ESCAPES)
+
+
+def copy_tests(tests):
+    """
+        Insert unsaved Test objects with a single COPY FROM STDIN and return them,
+        with their ids set. Ids are taken from the table sequence beforehand, so
+        rows are exactly the ones bulk_create would insert.
+
+        Falls back to bulk_create on databases other than Postgres.
+    """
+
+    if connection.vendor != 'postgresql':
+        return Test.objects.bulk_create(tests)
+
+    if len(tests) == 0:
+        return tests
+
+    table = Test._meta.db_table
+    fields = Test._meta.concrete_fields
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+            [table, Test._meta.pk.column, len(tests)],
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+
+        rows = StringIO()
+        for test, test_id in zip(tests, ids):
+            test.id = test_id
+            rows.write('\t'.join(copy_value(getattr(test, field.attname)) for field in fields))
+            rows.write('\n')
+        rows.seek(0)
+
+        cursor.copy_expert(f"COPY {connection.ops.quote_name(table)} ({columns}) FROM STDIN", rows)
+
+    for test in tests:
+        test._state.adding = False
+
+    logger.debug(f"Copied {len(tests)} tests")
+    return tests
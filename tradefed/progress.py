@@ -0,0 +1,117 @@
+import json
+import logging
+import time
+
+from datetime import datetime, timezone
+from django.db import transaction
+
+from squad.core.models import PluginScratch, TestRun
+
+
+logger = logging.getLogger()
+
+# Testrun metadata key where ingestion progress is published
+PROGRESS_METADATA_KEY = 'tradefed_progress'
+
+# Minimum number of seconds between two updates of the testrun metadata
+PROGRESS_PUBLISH_INTERVAL = 10
+
+
+def progress_metadata(progress, now):
+    """
+        Return what gets published in the testrun metadata for progress, with an
+        ETA in seconds from the chunks completed so far, or None before the first one.
+    """
+
+    total = progress['chunks_total']
+    completed = progress['chunks_completed']
+
+    eta = None
+    if completed >= total:
+        eta = 0
+    elif completed > 0:
+        eta = int((now - progress['started_at']) / completed * (total - completed))
+
+    return {
+        'chunks_total': total,
+        'chunks_completed': completed,
+        'tests_created': progress['tests_created'],
+        'eta_seconds': eta,
+        'updated_at': datetime.fromtimestamp(now, timezone.utc).isoformat(),
+    }
+
+
+def publish_progress(testrun, progress, now):
+    testrun.metadata[PROGRESS_METADATA_KEY] = progress_metadata(progress, now)
+    testrun.save(update_fields=['metadata_file'])
+
+
+def create_progress(testrun, chunks_total):
+    """
+        Store the progress counters of the ingestion of testrun in a PluginScratch,
+        publish them and return the PluginScratch id.
+    """
+
+    now = time.time()
+    progress = {
+        'chunks_total': chunks_total,
+        'chunks_completed': 0,
+        'tests_created': 0,
+        'started_at': now,
+        'published_at': now,
+    }
+
+    plugin_scratch = PluginScratch.objects.create(
+        build=testrun.build,
+        storage=json.dumps(progress),
+    )
+
+    publish_progress(testrun, progress, now)
+    return plugin_scratch.id
+
+
+def record_progress(testrun_id, progress_id, tests_created):
+    """
+        Count one more completed chunk, which created tests_created tests. The
+        counters row is locked meanwhile, and the testrun metadata is updated at
+        most every PROGRESS_PUBLISH_INTERVAL seconds, and when the last chunk is done.
+    """
+
+    now = time.time()
+    with transaction.atomic():
+        try:
+            scratch = PluginScratch.objects.select_for_update().get(pk=progress_id)
+        except PluginScratch.DoesNotExist:
+            return
+
+        progress = json.loads(scratch.storage)
+        progress['chunks_completed'] += 1
+        progress['tests_created'] += tests_created
+
+        publish = progress['chunks_completed'] >= progress['chunks_total'] or now - progress['published_at'] >= PROGRESS_PUBLISH_INTERVAL
+        if publish:
+            progress['published_at'] = now
+
+        scratch.storage = json.dumps(progress)
+        scratch.save(update_fields=['storage'])
+
+        if publish:
+            publish_progress(TestRun.objects.select_for_update().get(pk=testrun_id), progress, now)
+
+
+def finish_progress(testrun, progress_id):
+    """
+        Publish the final counters in the metadata of testrun, which is not saved,
+        and delete them.
+    """
+
+    try:
+        scratch = PluginScratch.objects.get(pk=progress_id)
+    except PluginScratch.DoesNotExist:
+        return
+
+    progress = json.loads(scratch.storage)
+    metadata = progress_metadata(progress, time.time())
+    metadata['eta_seconds'] = 0
+    testrun.metadata[PROGRESS_METADATA_KEY] = metadata
+    scratch.delete()
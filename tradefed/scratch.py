@@ -0,0 +1,104 @@
+import base64
+import binascii
+import json
+import zlib
+
+
+# Payloads starting with this header use the compact format below, anything
+# else is the plain JSON list of TestCase dicts used by earlier versions
+HEADER = 'tradefed-chunk/1:'
+
+COMPRESSION_LEVEL = 6
+
+
+def encode_testcases(testcases):
+    """
+        Encode a list of TestCase dicts, as collected by Tradefed._extract_cts_results,
+        into a compact string to be stored in PluginScratch.storage.
+
+        Only what create_testcase_tests needs is kept. Strings are interned in a
+        table and tests are laid out in columns of indexes into it, so repeated
+        names and results are stored once; logs, which only failed tests have,
+        are kept aside as (test index, log) pairs. The result is zlib-compressed
+        and base64-encoded, since storage is a text column.
+    """
+
+    strings = []
+    interned = {}
+
+    def intern(value):
+        index = interned.get(value)
+        if index is None:
+            index = interned[value] = len(strings)
+            strings.append(value)
+        return index
+
+    cases = []
+    counts = []
+    names = []
+    results = []
+    logs = []
+    for testcase in testcases:
+        tests = testcase['tests']
+        cases.append(intern(testcase.get('name')))
+        counts.append(len(tests))
+        for test in tests:
+            if 'log' in test:
+                logs.append([len(names), test['log']])
+            names.append(intern(test.get('name')))
+            results.append(intern(test.get('result')))
+
+    payload = json.dumps({
+        'strings': strings,
+        'cases': cases,
+        'counts': counts,
+        'names': names,
+        'results': results,
+        'logs': logs,
+    }, separators=(',', ':'))
+
+    compressed = zlib.compress(payload.encode(), COMPRESSION_LEVEL)
+    return HEADER + base64.b64encode(compressed).decode('ascii')
+
+
+def decode_tests(storage):
+    """
+        Return a list of (testcase name, test name, result, log) tuples from a
+        PluginScratch storage, either in the compact format or in plain JSON.
+        Tests without a StackTrace get an empty log.
+
+        Raises ValueError if storage can't be decoded.
+    """
+
+    if not storage.startswith(HEADER):
+        return [
+            (testcase.get('name'), test.get('name'), test.get('result'), test.get('log', ''))
+            for testcase in json.loads(storage)
+            for test in testcase['tests']
+        ]
+
+    try:
+        payload = zlib.decompress(base64.b64decode(storage[len(HEADER):]))
+    except (zlib.error, binascii.Error) as e:
+        raise ValueError(f"Corrupted chunk: {e}")
+
+    data = json.loads(payload)
+    strings = data['strings']
+    names = data['names']
+    results = data['results']
+    logs = dict(data['logs'])
+
+    tests = []
+    index = 0
+    for case, count in zip(data['cases'], data['counts']):
+        testcase_name = strings[case]
+        for _ in range(count):
+            tests.append((
+                testcase_name,
+                strings[names[index]],
+                strings[results[index]],
+                logs.get(index, ''),
+            ))
+            index += 1
+
+    return tests
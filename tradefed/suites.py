@@ -0,0 +1,63 @@
+import logging
+
+from squad.core.models import Suite, SuiteMetadata
+
+
+logger = logging.getLogger()
+
+# Create missing suites once this many are waiting
+DEFAULT_FLUSH_SIZE = 100
+
+
+class SuiteCache(object):
+    """
+        Suites of a project whose slug starts with a given prefix.
+
+        Existing suites are loaded with a single query when the cache is created.
+        Suites that don't exist yet are only recorded by `add` and get created in
+        bulk, along with their metadata, by `flush`, which runs on its own once
+        `flush_size` of them are waiting. Adding the same slug again, e.g. when a
+        module shows up more than once because of retries or shards, is free.
+    """
+
+    def __init__(self, project, prefix, flush_size=DEFAULT_FLUSH_SIZE):
+        self.project = project
+        self.flush_size = flush_size
+        self.pending = set()
+        self.suites = {suite.slug: suite for suite in Suite.objects.filter(project=project, slug__startswith=f"{prefix}/")}
+        logger.debug(f"Loaded {len(self.suites)} suites for {prefix}")
+
+    def add(self, slug):
+        if slug in self.suites:
+            return
+
+        self.pending.add(slug)
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def get(self, slug):
+        if slug in self.pending:
+            self.flush()
+        return self.suites.get(slug)
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        slugs = sorted(self.pending)
+        logger.debug(f"Creating {len(slugs)} suites")
+
+        # Same metadata as squad's own get_suite/create_suites, named '-', so
+        # existing rows are reused and unique_together prevents duplicates
+        SuiteMetadata.objects.bulk_create(
+            [SuiteMetadata(kind='suite', suite=slug, name='-') for slug in slugs],
+            ignore_conflicts=True,
+        )
+        metadata = {m.suite: m for m in SuiteMetadata.objects.filter(kind='suite', suite__in=slugs, name='-')}
+
+        Suite.objects.bulk_create(
+            [Suite(project=self.project, slug=slug, metadata=metadata.get(slug)) for slug in slugs],
+            ignore_conflicts=True,
+        )
+        self.suites.update({suite.slug: suite for suite in Suite.objects.filter(project=self.project, slug__in=slugs)})
+        self.pending = set()
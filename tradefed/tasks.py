@@ -1,97 +1,538 @@
-import logging
 import json
+import logging
+import xml.etree.ElementTree as ET
 
+from celery import signature
 from collections import defaultdict
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, Q, Value
+from django.db.models.functions import Concat
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 
-from squad.core.models import SuiteMetadata, Test, KnownIssue, Status, TestRun, PluginScratch
+from squad.core.models import Attachment, Suite, SuiteMetadata, Test, Status, TestRun, PluginScratch
 from squad.celery import app as celery
 from squad.core.utils import join_name
-from squad.core.tasks import RecordTestRunStatus
+from squad.core.tasks import RecordTestRunStatus, get_suite_version
 from squad.ci.tasks import update_testjob_status
 
+from .context import delete_ingestion_context, get_ingestion_context
+from .loader import copy_tests
+from .progress import finish_progress, record_progress
+from .scratch import decode_tests
+
 
 logger = logging.getLogger()
 
+# Maximum number of test names in a single IN query
+METADATA_QUERY_BATCH_SIZE = 1000
+
+# Status fields, in the same order as the counters returned by create_tests
+STATUS_COUNTERS = ('tests_pass', 'tests_fail', 'tests_xfail', 'tests_skip')
+
+# Testrun metadata key with the markers of the counters already recorded
+STATUS_COUNTERS_METADATA_KEY = 'tradefed_status_counters'
+
+# Testrun metadata key with the [suite id, passes] of tests not created in failures only mode
+PASSES_METADATA_KEY = 'tradefed_passes'
+
+# Postgres advisory lock key for the slots of PLUGINS_TRADEFED_GLOBAL_MAX_CHUNKS_IN_FLIGHT
+INGESTION_SLOTS_LOCK_KEY = 0x74726164
+
+# Seconds before a chunk tries again to get an ingestion slot
+INGESTION_SLOT_RETRY_DELAY = 10
+
 
 @celery.task(queue='ci_fetch')
-def update_build_status(results_list, testrun_id, job_id, job_status):
+def update_build_status(results_list, testrun_id, job_id, job_status, context_id=None):
 
     """
         There could be a scenario where the test job, and its test run as consequence, gets deleted
         by the user. Since this function is invoked upon task from the queue, by the time it actually
         gets invoked, the test run might not exist anymore.
     """
+    context = {}
+    if context_id is not None:
+        try:
+            context = get_ingestion_context(testrun_id, context_id)
+        except PluginScratch.DoesNotExist:
+            pass
+        delete_ingestion_context(testrun_id, context_id)
+
+    progress_id = context.get('progress_id')
+
     try:
         testrun = TestRun.objects.get(pk=testrun_id)
     except TestRun.DoesNotExist:
+        if progress_id is not None:
+            PluginScratch.objects.filter(pk=progress_id).delete()
         return
 
-    # Compute stats all at once
-    Status.objects.filter(test_run=testrun).all().delete()
-    testrun.status_recorded = False
-    RecordTestRunStatus()(testrun)
+    if progress_id is not None:
+        finish_progress(testrun, progress_id)
+        testrun.save(update_fields=['metadata_file'])
+
+    # Each lane returns the results of its chunks
+    results_list = [result for lane in results_list for result in (lane if isinstance(lane, list) else [lane])]
+
+    if context.get('failures_only', False):
+        # Passes have no Test rows in failures only mode, keep their counters so
+        # they survive any recomputation of the testrun status
+        passes = defaultdict(int)
+        for result in results_list:
+            if isinstance(result, (list, tuple)):
+                passes[result[0]] += result[1]
+        testrun.metadata[PASSES_METADATA_KEY] = [[suite_id, count] for suite_id, count in passes.items()]
+        testrun.save(update_fields=['metadata_file'])
+
+    if not record_status_counters(testrun, results_list, context_id):
+        # Compute stats all at once, passes are added back once it's saved
+        Status.objects.filter(test_run=testrun).all().delete()
+        testrun.status_recorded = False
+        RecordTestRunStatus()(testrun)
 
     update_testjob_status.delay(job_id, job_status)
 
 
-@celery.task(queue='ci_fetch')
-def create_testcase_tests(pluginscratch_id, suite_slug, testrun_id, suite_id):
+def record_status_counters(testrun, results_list, marker=None):
+    """
+        Add the [suite id, pass, fail, xfail, skip] counters returned by the chunk
+        tasks to the Status rows of testrun, so tests don't need to be counted again.
+
+        With a marker, e.g. the ingestion context id, counters are only added once
+        even if the callback runs again: markers already recorded are kept in the
+        testrun metadata, which is updated in the same transaction.
+
+        Returns False if that's not possible, because the testrun status was never
+        recorded or because a chunk didn't return counters, e.g. when it failed.
+    """
+
+    if not testrun.status_recorded:
+        return False
+
+    if any(not isinstance(result, (list, tuple)) for result in results_list):
+        logger.warning(f"Missing test counters for testrun {testrun.id}, recomputing its status")
+        return False
+
+    counters = defaultdict(lambda: [0] * len(STATUS_COUNTERS))
+    for suite_id, *counts in results_list:
+        for index, count in enumerate(counts):
+            counters[suite_id][index] += count
+            counters[None][index] += count
+
+    suite_ids = [suite_id for suite_id in counters.keys() if suite_id is not None]
+    with transaction.atomic():
+        if marker is not None:
+            locked = TestRun.objects.select_for_update().get(pk=testrun.pk)
+            recorded = locked.metadata.get(STATUS_COUNTERS_METADATA_KEY, [])
+            if marker in recorded:
+                logger.warning(f"Test counters {marker} were already recorded for testrun {testrun.id}")
+                return True
+
+            recorded.append(marker)
+            locked.metadata[STATUS_COUNTERS_METADATA_KEY] = recorded
+            locked.save(update_fields=['metadata_file'])
+            testrun.metadata[STATUS_COUNTERS_METADATA_KEY] = recorded
+
+        statuses = Status.objects.select_for_update().filter(test_run=testrun).filter(Q(suite_id__in=suite_ids) | Q(suite__isnull=True))
+        statuses = {status.suite_id: status for status in statuses}
+
+        new_suites = Suite.objects.in_bulk([suite_id for suite_id in suite_ids if suite_id not in statuses])
+        new_statuses = []
+        for suite_id, counts in counters.items():
+            status = statuses.get(suite_id)
+            if status is None:
+                suite = new_suites.get(suite_id)
+                status = Status(test_run=testrun, suite=suite, suite_version=get_suite_version(testrun, suite))
+                new_statuses.append(status)
+
+            for field, count in zip(STATUS_COUNTERS, counts):
+                setattr(status, field, getattr(status, field) + count)
+
+        Status.objects.bulk_update(statuses.values(), STATUS_COUNTERS)
+        Status.objects.bulk_create(new_statuses)
+
+    return True
+
+
+def apply_passes(testrun):
+    """
+        Set the passes of the Status rows of testrun to the passing tests it has
+        plus the passes kept in its metadata by failures only ingestion, whose
+        tests were never created. The result is the same no matter how many
+        times it runs.
+    """
+
+    passes = defaultdict(int)
+    for suite_id, count in testrun.metadata.get(PASSES_METADATA_KEY, []):
+        passes[suite_id] += count
+        passes[None] += count
+
+    counts = Test.objects.filter(test_run=testrun, result=True).values('suite_id').annotate(pass_count=Count('suite_id')).order_by()
+    for count in counts:
+        if count['suite_id'] in passes:
+            passes[count['suite_id']] += count['pass_count']
+        passes[None] += count['pass_count']
+
+    suite_ids = [suite_id for suite_id in passes.keys() if suite_id is not None]
+    with transaction.atomic():
+        statuses = Status.objects.select_for_update().filter(test_run=testrun).filter(Q(suite_id__in=suite_ids) | Q(suite__isnull=True))
+        statuses = {status.suite_id: status for status in statuses}
+
+        new_suites = Suite.objects.in_bulk([suite_id for suite_id in suite_ids if suite_id not in statuses])
+        new_statuses = []
+        for suite_id, count in passes.items():
+            status = statuses.get(suite_id)
+            if status is None:
+                suite = new_suites.get(suite_id)
+                status = Status(test_run=testrun, suite=suite, suite_version=get_suite_version(testrun, suite))
+                new_statuses.append(status)
+            status.tests_pass = count
+
+        Status.objects.bulk_update(statuses.values(), ['tests_pass'])
+        Status.objects.bulk_create(new_statuses)
+
+
+@receiver(post_save, sender=TestRun)
+def reapply_passes(sender, instance, update_fields=None, **kwargs):
+    """
+        RecordTestRunStatus saves the testrun once its status is recomputed from
+        its tests, which drops the passes of failures only ingestion. Add them back.
+    """
+
+    if update_fields is not None and 'status_recorded' not in update_fields:
+        return
+
+    if instance.status_recorded and PASSES_METADATA_KEY in instance.metadata:
+        apply_passes(instance)
+
+
+def get_or_create_test_metadata(suite_slug, test_names):
+    """
+        Return a dict mapping each of test_names to its SuiteMetadata in suite_slug.
+
+        Existing metadata is fetched with IN queries, the missing ones are created
+        with a single bulk_create, then read back. Rows created concurrently by other
+        workers are ignored on insert and picked up by the second read, so the
+        number of queries doesn't depend on the number of tests.
+    """
+
+    def fetch(names):
+        names = sorted(names)
+        metadata = {}
+        for index in range(0, len(names), METADATA_QUERY_BATCH_SIZE):
+            queryset = SuiteMetadata.objects.filter(suite=suite_slug, kind='test', name__in=names[index:index + METADATA_QUERY_BATCH_SIZE])
+            metadata.update({m.name: m for m in queryset})
+        return metadata
+
+    metadata = fetch(test_names)
+    missing = set(test_names) - set(metadata.keys())
+    if len(missing) > 0:
+        logger.debug(f"Creating {len(missing)} test metadata for {suite_slug}")
+        SuiteMetadata.objects.bulk_create(
+            [SuiteMetadata(suite=suite_slug, kind='test', name=name) for name in missing],
+            ignore_conflicts=True,
+        )
+        metadata.update(fetch(missing))
+
+    return metadata
+
+
+def record_chunk_progress(testrun_id, progress_id, tests_created):
+    """
+        Count a chunk as completed in the ingestion progress, if there's one. This
+        is best effort, errors are only logged.
+    """
+
+    if progress_id is None:
+        return
+
     try:
-        scratch = PluginScratch.objects.get(pk=pluginscratch_id)
-        test_cases = json.loads(scratch.storage)
+        record_progress(testrun_id, progress_id, tests_created)
+    except Exception as e:
+        logger.warning(f"Failed to record progress of testrun {testrun_id}: {e}")
+
+
+def get_progress_id(testrun_id, context_id):
+    if context_id is None:
+        return None
+
+    try:
+        return get_ingestion_context(testrun_id, context_id).get('progress_id')
     except PluginScratch.DoesNotExist:
-        logger.error(f"PluginScratch with ID: {pluginscratch_id} doesn't exist")
-        return
-    except ValueError as e:
-        logger.error(f"Failed to load json for PluginScratch ({pluginscratch_id}): {e}")
+        return None
 
-    testrun = TestRun.objects.get(pk=testrun_id)
-    issues = defaultdict(list)
-    for issue in KnownIssue.active_by_environment(testrun.environment):
-        issues[issue.test_name].append(issue)
+
+def create_tests(scratch_tests, suite_slug, testrun_id, suite_id, context_id=None):
+    """
+        Create tests in suite_slug from a list of (testcase name, test name, result, log)
+        tuples, linking them to the active known issues of the testrun environment,
+        as found in the ingestion context. In failures only mode, passing tests are
+        only counted.
+
+        Returns [suite_id, pass, fail, xfail, skip] counters of the tests, or None if
+        they couldn't be created.
+    """
 
     try:
+        context = get_ingestion_context(testrun_id, context_id)
+    except PluginScratch.DoesNotExist:
+        logger.error(f"Ingestion context with ID: {context_id} doesn't exist")
+        return None
+
+    issues = context['known_issues']
+    failures_only = context.get('failures_only', False)
+    progress_id = context.get('progress_id')
+    passes = 0
+    tests_created = 0
+
+    try:
+        logger.debug(f"Extracting {len(scratch_tests)} tests")
+        parsed_tests = []
+        for test_case_name, name, result, log in scratch_tests:
+            test_result = None
+            if result == "pass":
+                test_result = True
+                if failures_only:
+                    passes += 1
+                    continue
+            elif result in ["fail", "ASSUMPTION_FAILURE"]:
+                test_result = False
+
+            test_name = f"{test_case_name}.{name}"
+
+            # TODO: increase SQUAD's max length for test name
+            #       currently it's at 256 characters
+            test_name = test_name[:256]
+
+            parsed_tests.append((test_name, test_result, log))
+
+        metadata = get_or_create_test_metadata(suite_slug, {test_name for test_name, _, _ in parsed_tests})
+
         test_list = []
-        for test_case in test_cases:
-            test_case_name = test_case.get("name")
-
-            tests = test_case['tests']
-            logger.debug(f"Extracting TestCase: {test_case_name} - {len(tests)} testcases")
-            for test in tests:
-
-                test_result = None
-                if test.get("result") == "pass":
-                    test_result = True
-                elif test.get("result") in ["fail", "ASSUMPTION_FAILURE"]:
-                    test_result = False
-
-                test_name = f"{test_case_name}.{test.get('name')}"
-
-                # TODO: increase SQUAD's max length for test name
-                #       currently it's at 256 characters
-                test_name = test_name[:256]
-
-                metadata, _ = SuiteMetadata.objects.get_or_create(suite=suite_slug, name=test_name, kind='test')
-                full_name = join_name(suite_slug, test_name)
-                test_issues = issues.get(full_name, [])
-                test_list.append(Test(
-                    test_run=testrun,
-                    suite_id=suite_id,
-                    metadata=metadata,
-                    result=test_result,
-                    log=test.get('log', ''),
-                    has_known_issues=bool(test_issues),
-                    build=testrun.build,
-                    environment=testrun.environment,
-                ))
-
-        created_tests = Test.objects.bulk_create(test_list)
-        for test in created_tests:
-            if test.name in issues.keys():
-                test.known_issues.add(issues[test.name])
+        test_issues_list = []
+        for test_name, test_result, test_log in parsed_tests:
+            full_name = join_name(suite_slug, test_name)
+            test_issues = issues.get(full_name, [])
+            test_issues_list.append(test_issues)
+            test_list.append(Test(
+                test_run_id=context['testrun_id'],
+                suite_id=suite_id,
+                metadata=metadata[test_name],
+                result=test_result,
+                log=test_log,
+                has_known_issues=bool(test_issues),
+                build_id=context['build_id'],
+                environment_id=context['environment_id'],
+            ))
+
+        if context.get('loader') == 'copy':
+            created_tests = copy_tests(test_list)
+        else:
+            created_tests = Test.objects.bulk_create(test_list)
+
+        # Link known issues through the M2M table directly, all at once
+        TestKnownIssue = Test.known_issues.through
+        known_issues = [
+            TestKnownIssue(test_id=test.id, knownissue_id=issue_id)
+            for test, test_issues in zip(created_tests, test_issues_list)
+            for issue_id in test_issues
+        ]
+        if len(known_issues) > 0:
+            TestKnownIssue.objects.bulk_create(known_issues, ignore_conflicts=True)
+        tests_created = len(created_tests)
     except Exception as e:
         logger.error(f"CTS/VTS error: {e}")
+        return None
+    finally:
+        # Chunks that failed count as completed too, so progress doesn't stall
+        record_chunk_progress(context['testrun_id'], progress_id, tests_created)
+
+    counters = [suite_id, passes, 0, 0, 0]
+    for test in test_list:
+        if test.result is None:
+            counters[4] += 1
+        elif test.result:
+            counters[1] += 1
+        elif test.has_known_issues:
+            counters[3] += 1
+        else:
+            counters[2] += 1
+    return counters
+
+
+@celery.task(queue='ci_fetch')
+def create_testcase_tests(pluginscratch_id, suite_slug, testrun_id, suite_id, context_id=None):
+    try:
+        scratch = PluginScratch.objects.get(pk=pluginscratch_id)
+        scratch_tests = decode_tests(scratch.storage)
+    except PluginScratch.DoesNotExist:
+        logger.error(f"PluginScratch with ID: {pluginscratch_id} doesn't exist")
+        record_chunk_progress(testrun_id, get_progress_id(testrun_id, context_id), 0)
+        return
+    except ValueError as e:
+        logger.error(f"Failed to decode PluginScratch ({pluginscratch_id}): {e}")
+        scratch_tests = []
+
+    counters = create_tests(scratch_tests, suite_slug, testrun_id, suite_id, context_id)
 
     logger.info(f"Deleting PluginScratch with ID: {scratch.pk}")
     scratch.delete()
-    return 0
+    return counters
+
+
+def parse_tests_range(data):
+    """
+        Return a list of (testcase name, test name, result, log) tuples from a slice
+        of test_result.xml made of whole TestCase elements of a single Module.
+    """
+
+    root = ET.fromstring(b'<TestCases>' + data + b'</TestCases>')
+    tests = []
+    for testcase in root.iter('TestCase'):
+        for test in testcase.iter('Test'):
+            trace = test.find('.//StackTrace')
+            log = '' if trace is None else trace.text
+            tests.append((testcase.get('name'), test.get('name'), test.get('result'), log))
+    return tests
+
+
+@celery.task(queue='ci_fetch')
+def create_testcase_tests_from_range(attachment_id, start, end, suite_slug, testrun_id, suite_id, context_id=None):
+    """
+        Create the tests found between bytes start and end of a test_result.xml
+        attachment. The range is read straight from the attachment storage, so
+        each subtask only parses its own TestCases.
+    """
+
+    scratch_tests = None
+    try:
+        attachment = Attachment.objects.get(pk=attachment_id)
+        with attachment.storage.open('rb') as fp:
+            fp.seek(start)
+            data = fp.read(end - start)
+        scratch_tests = parse_tests_range(data)
+    except Attachment.DoesNotExist:
+        logger.error(f"Attachment with ID: {attachment_id} doesn't exist")
+        return
+    except (OSError, ET.ParseError) as e:
+        logger.error(f"Failed to read tests from Attachment ({attachment_id}) range {start}-{end}: {e}")
+        return
+    finally:
+        # Otherwise create_tests records the progress of this chunk
+        if scratch_tests is None:
+            record_chunk_progress(testrun_id, get_progress_id(testrun_id, context_id), 0)
+
+    return create_tests(scratch_tests, suite_slug, testrun_id, suite_id, context_id)
+
+
+@contextmanager
+def ingestion_slot():
+    """
+        Hold one of PLUGINS_TRADEFED_GLOBAL_MAX_CHUNKS_IN_FLIGHT slots shared by all
+        workers, yielding False if they are all taken. Slots are Postgres session
+        advisory locks, so they are released even if the worker dies. Without that
+        setting, or on other databases, a slot is always available.
+    """
+
+    limit = getattr(settings, "PLUGINS_TRADEFED_GLOBAL_MAX_CHUNKS_IN_FLIGHT", None)
+    if not limit or connection.vendor != 'postgresql':
+        yield True
+        return
+
+    # One slot per statement: a LIMIT doesn't stop Postgres from taking more
+    # locks than the row it returns, and those would never be released
+    slot = None
+    with connection.cursor() as cursor:
+        for candidate in range(limit):
+            cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", [INGESTION_SLOTS_LOCK_KEY, candidate])
+            if cursor.fetchone()[0]:
+                slot = candidate
+                break
+
+    if slot is None:
+        yield False
+        return
+
+    try:
+        yield True
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s, %s)", [INGESTION_SLOTS_LOCK_KEY, slot])
+
+
+def run_chunk(task, chunk):
+    """
+        Run the chunk task signature chunk inline, within an ingestion slot, and
+        return its result, or None if it failed. Without a free slot, task is
+        retried later.
+    """
+
+    with ingestion_slot() as acquired:
+        if not acquired:
+            logger.debug("No ingestion slot available, retrying later")
+            raise task.retry(countdown=INGESTION_SLOT_RETRY_DELAY)
+
+        try:
+            return signature(chunk, app=celery)()
+        except Exception as e:
+            # Keep the lane going; a missing result makes the status be recomputed
+            logger.error(f"Failed to ingest tradefed chunk {chunk}: {e}")
+            return None
+
+
+def create_lane(build, chunks):
+    """
+        Store the chunk task signatures of a lane in a PluginScratch and return
+        its id. The first line of the storage holds the chunks, and the result of
+        each chunk is appended as a line of its own once it runs.
+    """
+
+    plugin_scratch = PluginScratch.objects.create(build=build, storage=json.dumps(chunks))
+    return plugin_scratch.id
+
+
+@celery.task(bind=True, queue='ci_fetch', max_retries=None)
+def ingest_lane(self, lane_id, index=0):
+    """
+        Run chunk index of the lane stored in PluginScratch lane_id, then replace
+        this task with one for the next chunk, which goes to the back of the queue.
+        A chord of these lanes bounds how many chunks of a testrun are in flight
+        without keeping other tasks waiting.
+
+        Messages only carry the lane id and index, results are appended to the lane
+        storage. The last task returns the results of all the chunks and deletes
+        the lane.
+    """
+
+    chunks, *results = PluginScratch.objects.get(pk=lane_id).storage.split('\n')
+    chunks = json.loads(chunks)
+
+    # A redelivered task doesn't run its chunk again
+    if len(results) <= index:
+        result = run_chunk(self, chunks[index])
+        PluginScratch.objects.filter(pk=lane_id).update(storage=Concat(F('storage'), Value('\n' + json.dumps(result))))
+        results.append(json.dumps(result))
+
+    if index + 1 < len(chunks):
+        return self.replace(ingest_lane.s(lane_id, index + 1))
+
+    PluginScratch.objects.filter(pk=lane_id).delete()
+    return [json.loads(result) for result in results]
+
+
+@celery.task(bind=True, queue='ci_fetch', max_retries=None)
+def ingest_chunks(self, chunks, results=None):
+    """
+        Lanes queued by previous versions, which carry all their remaining chunks
+        and results along from one task to the next.
+    """
+
+    results = results or []
+    results.append(run_chunk(self, chunks[0]))
+
+    if len(chunks) > 1:
+        return self.replace(ingest_chunks.s(chunks[1:], results))
+    return results